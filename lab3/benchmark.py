@@ -0,0 +1,105 @@
+# micro benchmarks for the data structures of the server (no docker needed)
+# measures VectorClock compare/update/copy, Entry.to_dict, Board.add_entry, Board.get_ordered_entries and the status hash
+# for different numbers of entries and servers and writes the results to logs/benchmark_log_<date>.csv
+#
+# usage: python3 benchmark.py [max number of entries] [max number of servers]
+
+import sys
+import os
+import random
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server'))
+
+from vector_clock import VectorClock
+from board import Entry, Board
+
+MAX_ENTRIES = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+MAX_SERVERS = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+ENTRY_COUNTS = [n for n in [1000, 10000, 100000, 1000000] if n <= MAX_ENTRIES]
+SERVER_COUNTS = [n for n in [2, 4, 8, 16, 32, 64] if n <= MAX_SERVERS]
+CLOCK_REPETITIONS = 100000  # number of operations for the vector clock benchmarks
+BOARD_REPETITIONS = 5       # number of calls for the whole board benchmarks
+
+random.seed(0)
+
+log_path = 'logs/benchmark_log_' + datetime.now().strftime("%m-%d-%Y%-H-%M-%S") + '.csv'
+os.makedirs('logs', exist_ok=True)
+
+with open(log_path, 'a') as file:
+    file.write('operation,number of entries,number of servers,repetitions,total time,time per operation\n')
+
+
+def log(operation, num_entries, num_servers, repetitions, total_time):
+    with open(log_path, 'a') as file:
+        file.write(str(operation) + ',' + str(num_entries) + ',' + str(num_servers) + ',' + str(repetitions) + ','
+                   + str(total_time) + ',' + str(total_time / repetitions) + '\n')
+    print(f"{operation:28} entries={num_entries:>8} servers={num_servers:>3}: {total_time / repetitions * 1e6:12.3f} us/op")
+
+
+def measure(fn, repetitions):
+    start_time = time.perf_counter()
+    for _ in range(repetitions):
+        fn()
+    return time.perf_counter() - start_time
+
+
+def random_clock(num_servers, max_value=1000):
+    return VectorClock(n=num_servers, entries=[random.randint(0, max_value) for _ in range(num_servers)])
+
+
+def random_entry(num_servers):
+    return Entry(str(uuid.uuid4()), str(random.randint(0, 1000000)), random_clock(num_servers))
+
+
+def bench_vector_clock(num_servers):
+    a = random_clock(num_servers)
+    b = random_clock(num_servers)
+    c = a.copy()
+    c.update(b)  # c is greater than a and b
+
+    log('vector_clock_compare', 0, num_servers, CLOCK_REPETITIONS, measure(lambda: a < c, CLOCK_REPETITIONS))
+    log('vector_clock_is_parallel', 0, num_servers, CLOCK_REPETITIONS, measure(lambda: a.is_parallel(b), CLOCK_REPETITIONS))
+    log('vector_clock_update', 0, num_servers, CLOCK_REPETITIONS, measure(lambda: a.copy().update(b), CLOCK_REPETITIONS))
+    log('vector_clock_copy', 0, num_servers, CLOCK_REPETITIONS, measure(a.copy, CLOCK_REPETITIONS))
+    log('vector_clock_to_list', 0, num_servers, CLOCK_REPETITIONS, measure(a.to_list, CLOCK_REPETITIONS))
+
+    entry = random_entry(num_servers)
+    entry.modify_ts = random_clock(num_servers)
+    log('entry_to_dict', 0, num_servers, CLOCK_REPETITIONS, measure(entry.to_dict, CLOCK_REPETITIONS))
+
+
+def bench_board(num_entries, num_servers):
+    entries = [random_entry(num_servers) for _ in range(num_entries)]
+
+    board = Board()
+    start_time = time.perf_counter()
+    for entry in entries:
+        board.add_entry(entry)
+    log('board_add_entry', num_entries, num_servers, num_entries, time.perf_counter() - start_time)
+
+    # modify and delete re-add the same entry with changed timestamps
+    changed = random.sample(entries, max(1, num_entries // 10))
+    start_time = time.perf_counter()
+    for entry in changed:
+        entry.delete_ts = random_clock(num_servers)
+        board.add_entry(entry)
+    log('board_add_entry_delete', num_entries, num_servers, len(changed), time.perf_counter() - start_time)
+
+    log('board_get_ordered_entries', num_entries, num_servers, BOARD_REPETITIONS,
+        measure(board.get_ordered_entries, BOARD_REPETITIONS))
+    log('board_get_hash', num_entries, num_servers, CLOCK_REPETITIONS, measure(board.get_hash, CLOCK_REPETITIONS))
+    log('board_to_dict', num_entries, num_servers, BOARD_REPETITIONS,
+        measure(lambda: [entry.to_dict() for entry in board.get_ordered_entries()], BOARD_REPETITIONS))
+
+
+print(f"Writing results to {log_path}")
+for num_servers in SERVER_COUNTS:
+    bench_vector_clock(num_servers)
+
+for num_entries in ENTRY_COUNTS:
+    for num_servers in SERVER_COUNTS:
+        bench_board(num_entries, num_servers)
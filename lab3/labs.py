@@ -3,6 +3,7 @@ import os
 import sys
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import docker
 import requests
@@ -19,14 +20,25 @@ DOCKER_LABEL = str(os.getenv('DOCKER_LABEL'))
 FRONTEND_IMAGE = str(os.getenv('FRONTEND_IMAGE'))
 SERVER_IMAGE = str(os.getenv('SERVER_IMAGE'))
 LOG_PROXY = int(os.getenv('LOG_PROXY'))
+# optional: directory inside the server containers for their write-ahead log (DATA_DIR of server.py). Without it the
+# servers keep their board in memory only and the clients do not wait for an fsync
+SERVER_DATA_DIR = os.getenv('SERVER_DATA_DIR')
 
 PROXY_IMAGE = 'shopify/toxiproxy'
+PROXY_API = 'http://127.0.0.1:' + str(PROXY_PORT)
+PROXY_CONCURRENCY = 16  # number of parallel requests to the toxiproxy API
+PROXY_READY_TIMEOUT_S = 30
 
 num_servers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
 scenario_args = sys.argv[2:] if len(sys.argv) > 2 else []
 
 client = docker.from_env()
 
+# one keep-alive session for all requests to the toxiproxy API
+proxy_session = requests.Session()
+proxy_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=PROXY_CONCURRENCY))
+proxy_executor = ThreadPoolExecutor(max_workers=PROXY_CONCURRENCY)
+
 def attach_logs(container):
     def _print(name, stream):
         for line in stream:
@@ -75,34 +87,6 @@ for server_port in range(BASE_SERVER_PORT, BASE_SERVER_PORT + num_servers):
     external_server_list.append("127.0.0.1:" + str(server_port))
 
 external_server_list = ",".join(external_server_list)
-proxy_container = client.containers.run(PROXY_IMAGE,
-                                        detach=True,
-                                        labels={DOCKER_LABEL: 'proxy'},
-                                        name=DOCKER_LABEL + '_proxy',
-                                        hostname='proxy',
-                                        ports=proxy_ports,
-                                        environment={
-                                            "LOG_LEVEL": "error"
-                                        }
-                                        )
-
-if LOG_PROXY:
-    attach_logs(proxy_container)
-
-network.connect(proxy_container, aliases=['proxy'])
-
-frontend_container = client.containers.run(FRONTEND_IMAGE,
-                                           detach=True,
-                                           labels={DOCKER_LABEL: 'frontend'},
-                                           name=DOCKER_LABEL + '_frontend',
-                                           hostname='frontend',
-                                           ports={'80': FRONTEND_PORT},
-                                           environment={
-                                               "SERVER_LIST": external_server_list,
-                                               "GROUP_NAME": GROUP_NAME
-                                           }
-                                           )
-attach_logs(frontend_container)
 
 # A dictionary that contains the port mapping (from, to) -> port
 conn_pair_ports = {}
@@ -121,26 +105,92 @@ def get_server_list_str(from_server_id):
     return ",".join(sl)
 
 
-server_containers = []
-
-for server_id in range(0, num_servers):
+def start_proxy():
+    proxy_container = client.containers.run(PROXY_IMAGE,
+                                            detach=True,
+                                            labels={DOCKER_LABEL: 'proxy'},
+                                            name=DOCKER_LABEL + '_proxy',
+                                            hostname='proxy',
+                                            ports=proxy_ports,
+                                            environment={
+                                                "LOG_LEVEL": "error"
+                                            }
+                                            )
+
+    if LOG_PROXY:
+        attach_logs(proxy_container)
+
+    network.connect(proxy_container, aliases=['proxy'])
+    return proxy_container
+
+
+def start_frontend():
+    frontend_container = client.containers.run(FRONTEND_IMAGE,
+                                               detach=True,
+                                               labels={DOCKER_LABEL: 'frontend'},
+                                               name=DOCKER_LABEL + '_frontend',
+                                               hostname='frontend',
+                                               ports={'80': FRONTEND_PORT},
+                                               environment={
+                                                   "SERVER_LIST": external_server_list,
+                                                   "GROUP_NAME": GROUP_NAME
+                                               }
+                                               )
+    attach_logs(frontend_container)
+    return frontend_container
+
+
+def start_server(server_id):
     server_name = "server_{}".format(server_id)
+    environment = {
+        "SERVER_LIST": get_server_list_str(server_id),
+        "SERVER_ID": server_id
+    }
+    if SERVER_DATA_DIR:
+        environment["DATA_DIR"] = SERVER_DATA_DIR   # kept when the container is restarted
     server_container = client.containers.run(SERVER_IMAGE,
                                              detach=True,
                                              labels={DOCKER_LABEL: 'server'},
                                              name=DOCKER_LABEL + '_' + server_name,
                                              hostname=server_name,
-                                             environment={
-                                                 "SERVER_LIST": get_server_list_str(server_id),
-                                                 "SERVER_ID": server_id
-                                             }
+                                             environment=environment
                                              )
     attach_logs(server_container)
-    server_containers.append(server_container)
     network.connect(server_container, aliases=[server_name])
+    return server_container
+
+
+# the containers do not depend on each other, so they are all started at the same time
+with ThreadPoolExecutor(max_workers=num_servers + 2) as executor:
+    proxy_future = executor.submit(start_proxy)
+    frontend_future = executor.submit(start_frontend)
+    server_futures = [executor.submit(start_server, server_id) for server_id in range(0, num_servers)]
+
+    proxy_container = proxy_future.result()
+    frontend_container = frontend_future.result()
+    server_containers = [future.result() for future in server_futures]
+
+
+# wait until the API of toxiproxy answers before creating the proxies
+def wait_for_proxy(timeout_s=PROXY_READY_TIMEOUT_S):
+    deadline = time.time() + timeout_s
+    while time.time() < deadline:
+        try:
+            if proxy_session.get(PROXY_API + '/version', timeout=1).status_code == 200:
+                return True
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.05)
+    print("Toxiproxy did not start within {} seconds".format(timeout_s))
+    return False
+
+
+wait_for_proxy()
 
 # Create proxies
 
+proxies_data = []
+
 # Create external proxies as well
 for server_id in range(0, num_servers):
     to_server_name = "server_{}".format(server_id)
@@ -148,7 +198,7 @@ for server_id in range(0, num_servers):
 
     data = {'listen': "0.0.0.0:" + str(server_port), 'upstream': to_server_name + ":80",
             'name': "ext_" + to_server_name}
-    ret = requests.post('http://127.0.0.1:' + str(PROXY_PORT) + '/proxies', data=json.dumps(data).encode("utf-8"))
+    proxies_data.append(data)
 
 conn_pair_proxies_names = {}
 conn_pair_proxies_data = {}
@@ -161,18 +211,78 @@ for (f, t) in conn_pair_ports:
     data = {'listen': "0.0.0.0:" + str(p), 'upstream': to_server_name + ":80", 'name': name}
     conn_pair_proxies_names[(f, t)] = name
     conn_pair_proxies_data[(f, t)] = data
+    proxies_data.append(data)
 
-    ret = requests.post('http://127.0.0.1:' + str(PROXY_PORT) + '/proxies', data=json.dumps(data).encode("utf-8"))
+# all proxies are created with a single request
+ret = proxy_session.post(PROXY_API + '/populate', json=proxies_data)
 
 
 def print_proxies():
-    res = requests.get('http://127.0.0.1:' + str(PROXY_PORT) + '/proxies')
+    res = proxy_session.get(PROXY_API + '/proxies')
     print(res.json())
 
 
+# The scenarios below only describe the state they want for every pair proxy: whether it is enabled and its toxics
+# (name -> toxic data, the name is <type>_<stream>). apply() then sends just the differences to the current state
+# of toxiproxy, in parallel for all proxies, so switching scenarios does not recreate every toxic.
+def empty_proxy_state():
+    return {name: {'enabled': True, 'toxics': {}} for name in conn_pair_proxies_names.values()}
+
+
+current_state = empty_proxy_state()  # what toxiproxy has right now
+target_state = empty_proxy_state()   # what the scenario wants
+
+
+# returns the state the proxy actually reached, so a failed request is retried by the next apply()
+def apply_proxy(name, current, target):
+    url = PROXY_API + '/proxies/' + name
+    reached = {'enabled': current['enabled'], 'toxics': dict(current['toxics'])}
+    try:
+        for toxic_name in current['toxics']:
+            if toxic_name not in target['toxics']:
+                proxy_session.delete(url + '/toxics/' + toxic_name).raise_for_status()
+                del reached['toxics'][toxic_name]
+        for (toxic_name, data) in target['toxics'].items():
+            if toxic_name not in current['toxics']:
+                proxy_session.post(url + '/toxics', json=data).raise_for_status()
+            elif current['toxics'][toxic_name] != data:
+                proxy_session.post(url + '/toxics/' + toxic_name, json=data).raise_for_status()
+            reached['toxics'][toxic_name] = data
+        if current['enabled'] != target['enabled']:
+            proxy_session.post(url, json={'enabled': target['enabled']}).raise_for_status()
+            reached['enabled'] = target['enabled']
+    except Exception as e:
+        print(e)
+    return reached
+
+
+def apply():
+    global current_state, target_state
+    futures = {}
+    for (name, target) in target_state.items():
+        current = current_state[name]
+        if current != target:
+            futures[name] = proxy_executor.submit(apply_proxy, name, current, target)
+    for (name, future) in futures.items():
+        current_state[name] = future.result()
+    target_state = empty_proxy_state()
+
+
+def set_toxic(name, toxic_type, stream, toxicity, attributes):
+    toxic_name = toxic_type + '_' + stream
+    target_state[name]['toxics'][toxic_name] = {
+        'name': toxic_name,
+        'type': toxic_type,
+        'stream': stream,
+        'toxicity': toxicity,
+        'attributes': attributes
+    }
+
+
 # Some scenarios
 def clear():
-    requests.post('http://127.0.0.1:' + str(PROXY_PORT) + '/reset')
+    global target_state
+    target_state = empty_proxy_state()
 
 
 def add_partition(num_partitions=2):
@@ -180,33 +290,17 @@ def add_partition(num_partitions=2):
         # if they are not in the same "half" we disable their connections
         # note that this still allows connections to itself and symmetrically disables (t,f)
         if (f - t) % num_partitions != 0:
-            data = conn_pair_proxies_data[(f, t)]
-            data['enabled'] = False
-            requests.post('http://127.0.0.1:' + str(PROXY_PORT) + '/proxies/' + conn_pair_proxies_names[(t, f)], json=data)
+            target_state[conn_pair_proxies_names[(t, f)]]['enabled'] = False
 
 def remove_partition():
     for (f, t) in conn_pair_ports:
-        # if they are not in the same "half" we disable their connections
-        # note that this still allows connections to itself and symmetrically disables (t,f)
-        data = conn_pair_proxies_data[(f, t)]
-        data['enabled'] = True
-        requests.post('http://127.0.0.1:' + str(PROXY_PORT) + '/proxies/' + conn_pair_proxies_names[(t, f)], json=data)
+        target_state[conn_pair_proxies_names[(t, f)]]['enabled'] = True
 
 
 def add_loss(direction='upstream', p=0.1):
     for (f, t) in conn_pair_ports:
         if f != t:
-            data = {
-                'type': 'limit_data',
-                'stream': direction,
-                'toxicity': p,
-                'attributes': {
-                    'bytes': 0
-                }
-            }
-            res = requests.post(
-                'http://127.0.0.1:' + str(PROXY_PORT) + '/proxies/' + conn_pair_proxies_names[(t, f)] + '/toxics',
-                json=data)
+            set_toxic(conn_pair_proxies_names[(t, f)], 'limit_data', direction, p, {'bytes': 0})
 
 
 def add_request_loss(p=0.1):
@@ -220,18 +314,7 @@ def add_response_loss(p=0.1):
 def add_latency(direction='upstream', delay_ms=1000, jitter_ms=500):
     for (f, t) in conn_pair_ports:
         if f != t:
-            data = {
-                'type': 'latency',
-                'stream': direction,
-                'toxicity': 1.0,
-                'attributes': {
-                    'latency': delay_ms,
-                    'jitter': jitter_ms,
-                }
-            }
-            res = requests.post(
-                'http://127.0.0.1:' + str(PROXY_PORT) + '/proxies/' + conn_pair_proxies_names[(t, f)] + '/toxics',
-                json=data)
+            set_toxic(conn_pair_proxies_names[(t, f)], 'latency', direction, 1.0, {'latency': delay_ms, 'jitter': jitter_ms})
 
 
 def add_request_latency(delay_ms=1000, jitter_ms=500):
@@ -245,18 +328,7 @@ def add_response_latency(delay_ms=1000, jitter_ms=500):
 def add_bandwidth(direction='upstream', rate_kb=1000):
     for (f, t) in conn_pair_ports:
         if f != t:
-            data = {
-                'type': 'bandwidth',
-                'stream': direction,
-                'toxicity': 1.0,
-                'attributes': {
-                    'rate': rate_kb
-                }
-            }
-
-            res = requests.post(
-                'http://127.0.0.1:' + str(PROXY_PORT) + '/proxies/' + conn_pair_proxies_names[(t, f)] + '/toxics',
-                json=data)
+            set_toxic(conn_pair_proxies_names[(t, f)], 'bandwidth', direction, 1.0, {'rate': rate_kb})
 
 
 def add_request_bandwidth(rate_kb=1000):
@@ -269,17 +341,7 @@ def add_response_bandwidth(rate_kb=1000):
 def add_timeout(p=0.1, timeout_ms=60000):
     for (f, t) in conn_pair_ports:
         if f != t:
-            data = {
-                'type': 'timeout',
-                'stream': 'upstream',
-                'toxicity': p,
-                'attributes': {
-                    'timeout': timeout_ms
-                }
-            }
-            res = requests.post(
-                'http://127.0.0.1:' + str(PROXY_PORT) + '/proxies/' + conn_pair_proxies_names[(t, f)] + '/toxics',
-                json=data)
+            set_toxic(conn_pair_proxies_names[(t, f)], 'timeout', 'upstream', p, {'timeout': timeout_ms})
 
 
 # Unrealistic conditions, no loss, no timeouts, reorderings unlikely
@@ -353,6 +415,15 @@ def extract_scenarios_with_timeouts(scenario_args):
     return scs
 
 
+def switch_scenario(s):
+    print("Welcome to the {} scenario".format(s))
+    # we remove existing partitions
+    remove_partition()
+    scenarios[s]()
+    # send the differences to the previous scenario
+    apply()
+
+
 run_scenarios = extract_scenarios_with_timeouts(scenario_args)
 
 
@@ -372,10 +443,7 @@ try:
             continue
 
         if current_scenario is None or s != current_scenario:
-            print("Welcome to the {} scenario".format(s))
-            # we remove existing partitions
-            remove_partition()
-            scenarios[s]()
+            switch_scenario(s)
             current_scenario = s
 
         if t is not None:
@@ -399,15 +467,13 @@ try:
             continue
 
         if current_scenario is None or s != current_scenario:
-            print("Welcome to the {} scenario".format(s))
-            # we remove existing partitions
-            remove_partition()
-            scenarios[s]()
+            switch_scenario(s)
             current_scenario = s
 
 except KeyboardInterrupt:
     pass
 
 print("Shutting down...")
+proxy_executor.shutdown()
 remove()
 print("Finished")
\ No newline at end of file
@@ -5,12 +5,20 @@ import random
 import requests
 import threading
 import functools
+import json
 import math
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+STATUS_TIMEOUT_S = 2     # deadline of a single status request, a slow server then only counts as not answering
+SESSION_POOL_SIZE = 32   # keep-alive connections per server
+CONCURRENCY_PER_SERVER = 4  # parallel requests per server when adding, modifying or deleting entries in parallel
 
 class LabsControl:
-    def __init__(self, base_path):
+    # with local=True the servers run in a single local process (local_cluster.py) instead of docker containers
+    def __init__(self, base_path, local=False):
         self.base_path = base_path
+        self.local = local
         dotenv_path = base_path + '/.env'
         self.env = dotenv.dotenv_values(
             dotenv_path=dotenv_path
@@ -19,6 +27,8 @@ class LabsControl:
         self.sp = None
 
     def build(self):
+        if self.local:
+            return True  # nothing to build, the local servers use the server sources directly
         return subprocess.run("docker build -t ds_labs_server {}/server".format(self.base_path), shell=True, check=True).returncode == 0
 
 
@@ -27,7 +37,8 @@ class LabsControl:
         if self.sp is not None:
             return
         self.num_servers = num_servers
-        self.sp = subprocess.Popen("python {}/labs.py {} {} {}".format(self.base_path, num_servers, scenario, scenario_timeout), shell=True, stdin=subprocess.PIPE, encoding='utf-8')
+        script = 'local_cluster.py' if self.local else 'labs.py'
+        self.sp = subprocess.Popen("python {}/{} {} {} {}".format(self.base_path, script, num_servers, scenario, scenario_timeout), shell=True, stdin=subprocess.PIPE, encoding='utf-8')
 
     def change_scenario(self, s):
         if self.sp:
@@ -50,6 +61,11 @@ class LabsControl:
 class ServerManager():
     def __init__(self, server_list):
         self.server_list = server_list
+        # one keep-alive session shared by all requests, and a pool to ask all servers at the same time
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(server_list), pool_maxsize=SESSION_POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(server_list)))
 
     def req(self, srv_id, URI, req='POST', data=None, timeout_s=30):
         srv_ip = self.server_list[srv_id]
@@ -58,11 +74,11 @@ class ServerManager():
             if 'POST' in req:
                 # We handle data string as json for now
                 headers = {'Content-type': 'application/json', 'Accept': 'application/json'}
-                res = requests.post('http://{}{}'.format(srv_ip, URI), data=data, headers=headers,
+                res = self.session.post('http://{}{}'.format(srv_ip, URI), data=data, headers=headers,
                                     timeout=timeout_s)
             elif 'GET' in req:
                 headers = {'Accept': 'application/json'}
-                res = requests.get('http://{}{}'.format(srv_ip, URI), headers=headers, timeout=timeout_s)
+                res = self.session.get('http://{}{}'.format(srv_ip, URI), headers=headers, timeout=timeout_s)
                 # result can be accessed res.json()
             else:
                 res = None
@@ -77,16 +93,29 @@ class ServerManager():
     def post(self, srv_id, URI, data=None, timeout_s=30):
         return self.req(srv_id, URI, 'POST', data, timeout_s)
 
-    def get(self, srv_id, URI):
-        return self.req(srv_id, URI, 'GET', None)
+    def get(self, srv_id, URI, timeout_s=30):
+        return self.req(srv_id, URI, 'GET', None, timeout_s)
 
-    def status(self, id):
-        s, r = self.req(id, "/status", 'GET')
+    def status(self, id, timeout_s=STATUS_TIMEOUT_S):
+        s, r = self.get(id, "/status", timeout_s)
         if s:
             return r.json()
         else:
             return None
 
+    # the status of all servers (None if a server did not answer), requested concurrently
+    def status_all(self, timeout_s=STATUS_TIMEOUT_S):
+        return list(self.executor.map(lambda id: self.status(id, timeout_s), range(len(self.server_list))))
+
+    # readiness probe with a short timeout, a server that is still starting refuses the connection right away.
+    # Errors are expected here, so they are not printed
+    def ready(self, id):
+        try:
+            res = self.session.get('http://{}/ready'.format(self.server_list[id]), timeout=1)
+            return res.status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
     def entries(self, id):
         s, r = self.req(id, "/entries", 'GET')
         if s:
@@ -139,31 +168,126 @@ class CrashManager():
         else:
             return False
 
+# Log-linear histogram like HdrHistogram: the values (in microseconds) are grouped by their power of two, and every
+# power of two is split into SUB_BUCKETS linear buckets. The relative error is therefore at most 1 / SUB_BUCKETS,
+# independent of the value, and recording is O(1) with a bounded amount of memory, also for long load tests
+class Histogram:
+    SUB_BUCKET_BITS = 7
+    SUB_BUCKETS = 2 ** SUB_BUCKET_BITS
+
+    def __init__(self):
+        self.counts = {}    # (exponent, sub bucket) -> number of values
+        self.count = 0
+        self.errors = 0
+        self.total = 0      # sum of the values, for the mean
+        self.max = 0
+
+    def bucket_of(self, value):
+        exponent = max(0, value.bit_length() - self.SUB_BUCKET_BITS)
+        return (exponent, value >> exponent)
+
+    def record(self, value_s, success=True):
+        value = int(value_s * 1e6)
+        bucket = self.bucket_of(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.errors += 0 if success else 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def add(self, other):
+        for (bucket, count) in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.errors += other.errors
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    # the upper end of the bucket that contains the given percentile (0..1, in seconds)
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        required = max(1, int(math.ceil(p * self.count)))
+        seen = 0
+        for (exponent, sub_bucket) in sorted(self.counts.keys()):
+            seen += self.counts[(exponent, sub_bucket)]
+            if seen >= required:
+                return min(((sub_bucket + 1) << exponent) - 1, self.max) / 1e6
+        return self.max / 1e6
+
 class EntryManager:
-    def __init__(self, sm : ServerManager):
+    # requests to the same server run on a pool of concurrency_per_server worker threads, so a load test with thousands
+    # of entries only uses a bounded number of threads and connections. The latency of every request is recorded in a
+    # histogram per server and operation
+    def __init__(self, sm : ServerManager, concurrency_per_server=CONCURRENCY_PER_SERVER):
         self.sm = sm
+        self.executors = [ThreadPoolExecutor(max_workers=concurrency_per_server) for _ in sm.server_list]
+        self.histograms = {}  # (server id, operation) -> Histogram
+        self.latencies_lock = threading.Lock()
 
     def handle(self, callbacks, in_parallel=False):
-        res = None
         if in_parallel:
-            res = [None for cb in callbacks]
-            threads = []
-            for i, cb in enumerate(callbacks):
-                def wrapped_cb(idx, cb):
-                    res[idx] = cb()
-
-                threads.append(threading.Thread(target=functools.partial(wrapped_cb, i, cb), args=()))
-
-            for t in threads:
-                t.start()
-
-            for t in threads:
-                t.join()
-        else:
-            res = [
-                cb() for cb in callbacks
-            ]
-        return res
+            futures = [self.sm.executor.submit(cb) for cb in callbacks]
+            return [future.result() for future in futures]
+        return [cb() for cb in callbacks]
+
+    # runs the requests (server id, operation, callback), in parallel on the pools of the servers or one after another.
+    # A callback returns (success, response), or (success, response, operation) if it did another operation than planned.
+    # With a rate (requests per second over all servers) the requests are started at a fixed pace, independent of how
+    # long the servers take to answer (open loop). Their latency is then measured from the scheduled start, so the
+    # time a request waits for a free worker behind slow ones is not hidden
+    def run_requests(self, jobs, parallel=False, rate=None):
+        start_time = time.perf_counter()
+        results = []
+        for i, (server_id, operation, cb) in enumerate(jobs):
+            scheduled = None
+            if rate is not None:
+                scheduled = start_time + i / rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            if parallel:
+                results.append(self.executors[server_id].submit(self.timed, server_id, operation, cb, scheduled))
+            else:
+                results.append(self.timed(server_id, operation, cb, scheduled))
+        return [result.result() for result in results] if parallel else results
+
+    def timed(self, server_id, operation, cb, scheduled=None):
+        start = time.perf_counter() if scheduled is None else scheduled
+        result = cb()
+        latency = time.perf_counter() - start
+        success, res = result[0], result[1]
+        if len(result) > 2:
+            operation = result[2]
+        with self.latencies_lock:
+            key = (server_id, operation)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].record(latency, success)
+        return success, res
+
+    # count, mean and percentiles of the recorded latencies (in seconds), optionally only of one operation and server
+    def latency_summary(self, operation=None, server_id=None):
+        histogram = Histogram()
+        with self.latencies_lock:
+            for ((s, o), h) in self.histograms.items():
+                if (operation is None or o == operation) and (server_id is None or s == server_id):
+                    histogram.add(h)
+        if histogram.count == 0:
+            return {'count': 0}
+        return {
+            'count': histogram.count,
+            'errors': histogram.errors,
+            'mean': histogram.total / histogram.count / 1e6,
+            'p50': histogram.percentile(0.5),
+            'p99': histogram.percentile(0.99),
+            'p999': histogram.percentile(0.999),
+            'max': histogram.max / 1e6,
+        }
+
+    def clear_latencies(self):
+        with self.latencies_lock:
+            self.histograms = {}
 
     def add_entry_to_sever(self, server_id, value):
         return self.sm.post(server_id, '/entries', data={'value': str(value)})
@@ -182,55 +306,84 @@ class EntryManager:
         callbacks = [functools.partial(self.get_entry_ids_from_server, sid) for sid in range(len(self.sm.server_list))]
         return self.handle(callbacks)
 
-    def add_entries(self, count, servers, parallel=False):
-        def add_entries_cb(server):
-            for i in range(count):
-                self.add_entry_to_sever(server, random.randint(0, 1000000))
-
-        callbacks = [functools.partial(add_entries_cb, server) for server in servers]
-        return self.handle(callbacks, parallel)
+    # the requests of the servers are interleaved, so that every server gets its share of a given rate
+    def add_entries(self, count, servers, parallel=False, rate=None):
+        jobs = [(server, 'add', functools.partial(self.add_entry_to_sever, server, random.randint(0, 1000000)))
+                for i in range(count) for server in servers]
+        return self.run_requests(jobs, parallel, rate)
 
-    def modify_entries(self, count, servers, parallel=False):
+    def sample_entry_ids(self, count, servers):
         entry_ids_all = self.get_entry_ids_for_all_servers()
-
-        def modify_entries_cb(server):
+        sampled = []
+        for server in servers:
             entry_ids = entry_ids_all[server]
             if len(entry_ids) == 0:
-                return
+                continue
 
             k = min(count, len(entry_ids)) if count is not None and count != 'all' else len(entry_ids)
-            sampled_ids = random.sample(entry_ids, k)
-
-            for eid in sampled_ids:
-                self.modify_entry_on_sever(server, eid, random.randint(0, 1000000))
-
-        callbacks = [functools.partial(modify_entries_cb, server) for server in servers]
-        return self.handle(callbacks, parallel)
-
-    def delete_entries(self, count, servers, parallel=False):
-        entry_ids_all = self.get_entry_ids_for_all_servers()
-
-        def modify_entries_cb(sid):
-            entry_ids = entry_ids_all[sid]
-
-            if len(entry_ids) == 0:
-                return
+            sampled.append((server, random.sample(entry_ids, k)))
+        return sampled
+
+    def modify_entries(self, count, servers, parallel=False, rate=None):
+        jobs = [(server, 'modify', functools.partial(self.modify_entry_on_sever, server, eid, random.randint(0, 1000000)))
+                for (server, sampled_ids) in self.sample_entry_ids(count, servers) for eid in sampled_ids]
+        return self.run_requests(jobs, parallel, rate)
+
+    def delete_entries(self, count, servers, parallel=False, rate=None):
+        jobs = [(server, 'delete', functools.partial(self.delete_entry_on_sever, server, eid))
+                for (server, sampled_ids) in self.sample_entry_ids(count, servers) for eid in sampled_ids]
+        return self.run_requests(jobs, parallel, rate)
+
+class ChangeWatcher():
+    # follows GET /changes of every server with one long-poll thread each and keeps the latest state (version, len, hash)
+    # of every server. Waiting for a condition on those states wakes up on every change instead of polling /status
+    def __init__(self, server_list, poll_timeout_s=10):
+        self.server_list = server_list
+        self.poll_timeout_s = poll_timeout_s
+        self.states = [None for _ in server_list]
+        self.changed = threading.Condition()
+        self.running = True
+        for srv_id in range(len(server_list)):
+            threading.Thread(target=self.watch, args=(srv_id,), daemon=True).start()
+
+    def watch(self, srv_id):
+        session = requests.Session()
+        version = -1
+        while self.running:
+            try:
+                res = session.get('http://{}/changes'.format(self.server_list[srv_id]),
+                                  params={'since': version, 'timeout': self.poll_timeout_s}, timeout=self.poll_timeout_s + 5)
+                state = res.json() if res.status_code == 200 else None
+            except requests.exceptions.RequestException:
+                state = None
+            if state is None:
+                time.sleep(0.1)  # not reachable (yet), try again a bit later
+            else:
+                version = state['version']
+            with self.changed:
+                self.states[srv_id] = state
+                self.changed.notify_all()
 
-            k = min(count, len(entry_ids)) if count is not None and count != 'all' else len(entry_ids)
-            sampled_ids = random.sample(entry_ids, k)
+    # waits until predicate(states) is true, returns (elapsed time, result) like DSLTestControl.wait_until
+    def wait_until(self, predicate, timeout=None):
+        start_time = time.time()
+        with self.changed:
+            result = self.changed.wait_for(lambda: predicate(self.states), timeout)
+        return time.time() - start_time, result
 
-            for eid in sampled_ids:
-                self.delete_entry_on_sever(sid, eid)
+    def stop(self):
+        self.running = False
 
-        callbacks = [functools.partial(modify_entries_cb, server) for server in servers]
-        return self.handle(callbacks, parallel)
 
 class DSLTestControl():
 
     def __init__(self, lc: LabsControl):
         self.lc = lc
+        self.watcher = None
+        self.round_cache = None  # set while wait_until evaluates an assertion, so all checks of one round share one status snapshot
 
-    def init_servers(self, count):
+    # returns as soon as every server answers its readiness probe (or after the timeout)
+    def init_servers(self, count, timeout=60):
         print(f"initing {count} servers")
         self.lc.shutdown()
         self.lc.start_scenario(num_servers=count, scenario_timeout=0)
@@ -238,6 +391,22 @@ class DSLTestControl():
         self.sm = ServerManager(self.lc.get_server_list(count))
         self.cm = CrashManager(self.sm)
         self.em = EntryManager(self.sm)
+        if self.watcher is not None:
+            self.watcher.stop()
+        self.watcher = ChangeWatcher(self.sm.server_list)
+        return self.wait_until_ready(timeout)
+
+    def wait_until_ready(self, timeout=None):
+        pending = set(range(self.lc.num_servers))
+
+        def assertion_ready():
+            # only the servers that did not answer yet are probed again, all of them at the same time
+            servers = sorted(pending)
+            ready = self.em.handle([functools.partial(self.sm.ready, s) for s in servers], in_parallel=True)
+            pending.difference_update([s for (s, r) in zip(servers, ready) if r])
+            return len(pending) == 0
+
+        return self.wait_until(assertion_ready, timeout=timeout)
 
     def parse_server_args(self, servers):
         if servers == 'all' or servers == '100%':
@@ -280,6 +449,18 @@ class DSLTestControl():
         print(f"Scenario {name}")
         self.lc.change_scenario(name)
 
+    # clears board, clock and outgoing messages of all servers, so the running cluster can be reused for the next test.
+    # The reset always covers the whole cluster: every server moves to the same new epoch (above the epoch of any
+    # server), and a server that misses the request adopts it from the messages of the others
+    def reset_servers(self):
+        print("Resetting all servers")
+        epochs = [status['epoch'] for status in self.sm.status_all() if status is not None]
+        data = json.dumps({'epoch': max(epochs, default=0) + 1})
+        ids = range(self.lc.num_servers)
+        results = self.em.handle([functools.partial(self.sm.post, s, "/reset", data) for s in ids], in_parallel=True)
+        self.cm.crashed_servers.clear()
+        return all([success for (success, _) in results])
+
     def crash_servers(self, servers):
         print(f"Crashing servers {servers}")
         for s in self.parse_server_args(servers):
@@ -291,15 +472,24 @@ class DSLTestControl():
         for s in self.parse_server_args(servers):
             self.cm.recover_server(s)
 
+    # the status of all servers, fetched once per assertion round
+    def status_snapshot(self):
+        if self.round_cache is None:
+            return self.sm.status_all()
+        if 'status' not in self.round_cache:
+            self.round_cache['status'] = self.sm.status_all()
+        return self.round_cache['status']
+
     def assertion_online(self, servers):
         print(f"assertion_online servers {servers}")
-        return all([self.sm.status(s) is not None for s in self.parse_server_args(servers)])
+        snapshot = self.status_snapshot()
+        return all([snapshot[s] is not None for s in self.parse_server_args(servers)])
 
     def assertion_equal(self, percentage, servers):
         try:
             print(f"assertion_equal servers {servers}")
 
-            all_hashes = [self.sm.status(s)['hash'] for s in range(self.lc.num_servers)]
+            all_hashes = [status['hash'] for status in self.status_snapshot()]
 
             num_required = self.parse_percentage(percentage)
 
@@ -322,7 +512,7 @@ class DSLTestControl():
 
             print(f"assertion_equal_length servers {servers}")
 
-            all_lens = [self.sm.status(s)['len'] for s in range(self.lc.num_servers)]
+            all_lens = [status['len'] for status in self.status_snapshot()]
 
             num_required = self.parse_percentage(percentage)
 
@@ -342,37 +532,59 @@ class DSLTestControl():
         try:
             print(f"assertion_length servers {servers}")
 
+            snapshot = self.status_snapshot()
             for s in self.parse_server_args(servers):
-                if self.sm.status(s)['len'] != num_required:
-                    print(f"assertion_equal_length failed", self.sm.status(s)['len'], num_required)
+                if snapshot[s]['len'] != num_required:
+                    print(f"assertion_equal_length failed", snapshot[s]['len'], num_required)
                     return False
             return True
         except Exception as e:
             print(f"assertion_equal failed with exception {e}")
             return False
 
+    def evaluate_round(self, assertion):
+        self.round_cache = {}
+        try:
+            return assertion()
+        finally:
+            self.round_cache = None
+
     def wait_until(self, assertion, timeout=None):
         print(f"Waiting until {assertion}")
         start_time = time.time()
-        while not assertion():
+        while not self.evaluate_round(assertion):
             # print("Sleeping!")
             time.sleep(0.1)  # sleep for 100 ms to not overwhelm the servers...
             if timeout is not None and time.time() - start_time > timeout:
                 print("Timeout!")
                 break
         end_time = time.time()
-        return end_time - start_time, assertion()
+        return end_time - start_time, self.evaluate_round(assertion)
         # print(f"Waited for {end_time - start_time:.2f} seconds")  # todo Log time!
 
+    # the following waits are decided on the states pushed by the ChangeWatcher, so they end right after the last change
+    def same_state(self, states, servers, number_of_entries=None):
+        states = [states[s] for s in servers]
+        if any([state is None for state in states]):
+            return False
+        if number_of_entries is not None and any([state['len'] != number_of_entries for state in states]):
+            return False
+        return all([state['hash'] == states[0]['hash'] for state in states])
+
+    def wait_until_all_equal(self, timeout=None):
+        print("Waiting until all servers are equal")
+        servers = self.parse_server_args('all')
+        return self.watcher.wait_until(lambda states: self.same_state(states, servers), timeout=timeout)
+
     def wait_until_all_same_state(self, number_of_entries, timeout=None):
-        return self.wait_until(
-            lambda: self.assertion_equal('all', 'all') and self.assertion_length(number_of_entries, 'all'),
-            timeout=timeout
-        )
+        print(f"Waiting until all servers have the same {number_of_entries} entries")
+        servers = self.parse_server_args('all')
+        return self.watcher.wait_until(lambda states: self.same_state(states, servers, number_of_entries), timeout=timeout)
 
     def wait_until_all_partitions_same_state(self, number_of_entries, partitions, timeout=None):
-        partition_assertion = lambda: all([self.assertion_equal(len(p), p) and self.assertion_length(number_of_entries, p) for p in partitions])
-        return self.wait_until(partition_assertion, timeout=timeout)
+        print(f"Waiting until all partitions {partitions} have the same {number_of_entries} entries")
+        partition_assertion = lambda states: all([self.same_state(states, p, number_of_entries) for p in partitions])
+        return self.watcher.wait_until(partition_assertion, timeout=timeout)
 
 
     def waits(self, secs):
@@ -383,17 +595,25 @@ class DSLTestControl():
         print(f"Assertion took {end_time - start_time:.2f} seconds")
         print(f"Assertion {'succeeded' if succ else 'failed'}")
 
-    def add_entries(self, count, servers, parallel=False):
+    # rate: requests per second over all given servers (None = as fast as possible)
+    def add_entries(self, count, servers, parallel=False, rate=None):
         print(f"Adding {count} entries to servers {servers} {'in parallel' if parallel else ''}")
-        self.em.add_entries(count, self.parse_server_args(servers), parallel)
+        self.em.add_entries(count, self.parse_server_args(servers), parallel, rate)
 
-    def modify_entries(self, count, servers, parallel=False):
+    def modify_entries(self, count, servers, parallel=False, rate=None):
         print(f"Updating {count} entries on servers {servers} {'in parallel' if parallel else ''}")
-        self.em.modify_entries(count, self.parse_server_args(servers), parallel)
+        self.em.modify_entries(count, self.parse_server_args(servers), parallel, rate)
 
-    def delete_entries(self, count, servers, parallel=False):
+    def delete_entries(self, count, servers, parallel=False, rate=None):
         print(f"Deleting {count} entries on servers {servers} {'in parallel' if parallel else ''}")
-        self.em.delete_entries(count, self.parse_server_args(servers), parallel)
+        self.em.delete_entries(count, self.parse_server_args(servers), parallel, rate)
+
+    def print_latencies(self):
+        for operation in ['add', 'modify', 'delete']:
+            summary = self.em.latency_summary(operation)
+            if summary['count'] > 0:
+                print(f"{operation}: {summary['count']} requests, {summary['errors']} errors, mean {summary['mean'] * 1000:.1f} ms, "
+                      f"p50 {summary['p50'] * 1000:.1f} ms, p99 {summary['p99'] * 1000:.1f} ms, max {summary['max'] * 1000:.1f} ms")
 
 if __name__ == "__main__":
 
@@ -0,0 +1,118 @@
+# Open-loop load generator: sends a mix of create/modify/delete requests to the servers at a fixed arrival rate.
+# The requests run on the worker pools of EntryManager.run_requests, which starts them at a fixed pace and measures
+# the latency of every request from its scheduled start, so requests that queue up behind slow ones are not hidden
+# (no coordinated omission). The latencies are recorded per server and operation in log-linear (HDR-style) histograms
+# and summarized per scenario with EntryManager.latency_summary, printed and written to logs/load_log_<date>.csv
+#
+# usage: python3 load_generator.py <num-servers> <rate (requests/s)> <duration per scenario (s)> <mix> <scenario> <scenario> ...
+#   mix: share of create,modify,delete, e.g. 0.6,0.3,0.1
+#   add --local to run the servers with local_cluster.py instead of docker
+
+import sys
+import os
+import random
+import threading
+import time
+import functools
+from datetime import datetime
+
+from labs_control import LabsControl, DSLTestControl
+
+LOCAL = '--local' in sys.argv
+args = [arg for arg in sys.argv[1:] if arg != '--local']
+
+NUM_SERVERS = int(args[0]) if len(args) > 0 else 4
+RATE = float(args[1]) if len(args) > 1 else 100
+DURATION_S = float(args[2]) if len(args) > 2 else 10
+MIX = [float(share) for share in args[3].split(',')] if len(args) > 3 else [0.6, 0.3, 0.1]
+SCENARIOS = args[4:] if len(args) > 4 else ['perfect']
+
+OPERATIONS = ['create', 'modify', 'delete']
+SCENARIO_SETTLE_S = 1        # time for the scenario change to reach the proxies
+
+random.seed(0)
+
+
+class LoadGenerator:
+    def __init__(self, dsl_ctrl: DSLTestControl):
+        self.em = dsl_ctrl.em
+        self.num_servers = len(dsl_ctrl.sm.server_list)
+        self.entry_ids = [[] for _ in range(self.num_servers)]  # ids of the entries we created, per server
+        self.lock = threading.Lock()
+
+    # runs rate * duration_s requests and returns the elapsed time, the latencies are recorded by the EntryManager
+    def run(self, rate, duration_s, mix):
+        self.em.clear_latencies()
+        available = [len(entry_ids) for entry_ids in self.entry_ids]
+        jobs = []
+        for i in range(int(rate * duration_s)):
+            server_id = i % self.num_servers
+            operation = random.choices(OPERATIONS, weights=mix)[0]
+            if operation != 'create' and available[server_id] == 0:
+                operation = 'create'  # nothing to modify or delete yet
+            available[server_id] += {'create': 1, 'modify': 0, 'delete': -1}[operation]
+            jobs.append((server_id, operation, functools.partial(self.request, server_id, operation)))
+
+        start_time = time.perf_counter()
+        self.em.run_requests(jobs, parallel=True, rate=rate)
+        return time.perf_counter() - start_time
+
+    # returns (success, response, operation), the operation actually done is recorded by the EntryManager
+    def request(self, server_id, operation):
+        with self.lock:
+            entry_ids = self.entry_ids[server_id]
+            entry_id = random.choice(entry_ids) if len(entry_ids) > 0 else None
+            if operation == 'delete' and entry_id is not None:
+                entry_ids.remove(entry_id)
+        if entry_id is None:
+            operation = 'create'  # the planned creates are still running, rare with a mix that mostly creates
+
+        if operation == 'create':
+            success, res = self.em.add_entry_to_sever(server_id, random.randint(0, 1000000))
+            if success:
+                with self.lock:
+                    self.entry_ids[server_id].append(res.json()['id'])
+        elif operation == 'modify':
+            success, res = self.em.modify_entry_on_sever(server_id, entry_id, random.randint(0, 1000000))
+        else:
+            success, res = self.em.delete_entry_on_sever(server_id, entry_id)
+        return success, res, operation
+
+
+def report(log_path, scenario, em, num_servers, elapsed):
+    print(f"#### Scenario {scenario}: {em.latency_summary()['count']} requests in {elapsed:.2f} s")
+    for server_id in range(num_servers):
+        for operation in OPERATIONS:
+            summary = em.latency_summary(operation, server_id)
+            if summary['count'] == 0:
+                continue
+            throughput = (summary['count'] - summary['errors']) / elapsed
+            print(f"server {server_id} {operation:6}: {summary['count']:>6} requests, {summary['errors']:>4} errors, "
+                  f"{throughput:8.1f} ops/s, p50 {summary['p50'] * 1000:8.2f} ms, p99 {summary['p99'] * 1000:8.2f} ms, "
+                  f"p999 {summary['p999'] * 1000:8.2f} ms, max {summary['max'] * 1000:8.2f} ms")
+            with open(log_path, 'a') as file:
+                file.write(scenario + ',' + str(server_id) + ',' + operation + ',' + str(summary['count']) + ','
+                           + str(summary['errors']) + ',' + str(throughput) + ',' + str(summary['p50']) + ','
+                           + str(summary['p99']) + ',' + str(summary['p999']) + ',' + str(summary['max']) + '\n')
+
+
+if __name__ == "__main__":
+    log_path = 'logs/load_log_' + datetime.now().strftime("%m-%d-%Y%-H-%M-%S") + '.csv'
+    os.makedirs('logs', exist_ok=True)
+    with open(log_path, 'a') as file:
+        file.write('scenario,server,operation,requests,errors,throughput,p50,p99,p999,max\n')
+
+    lc = LabsControl('.', local=LOCAL)
+    dsl_ctrl = DSLTestControl(lc)
+    try:
+        lc.build()
+        dsl_ctrl.init_servers(NUM_SERVERS)
+        generator = LoadGenerator(dsl_ctrl)
+        for scenario in SCENARIOS:
+            dsl_ctrl.change_scenario(scenario)
+            dsl_ctrl.waits(SCENARIO_SETTLE_S)
+            elapsed = generator.run(RATE, DURATION_S, MIX)
+            report(log_path, scenario, dsl_ctrl.em, generator.num_servers, elapsed)
+        print(f"Results written to {log_path}")
+    finally:
+        lc.shutdown()
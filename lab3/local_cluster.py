@@ -0,0 +1,261 @@
+# Runs the servers in a single local process instead of docker containers + toxiproxy.
+# The network conditions of the scenarios in labs.py are injected by the servers themselves when sending messages,
+# so starting a cluster takes well under a second and dozens of servers can run on one machine.
+#
+# usage (same as labs.py): python3 local_cluster.py <num-servers> <scenario> <scenario timeout (s)> ...
+# scenarios can also be changed through stdin (see LabsControl(..., local=True))
+
+import os
+import sys
+import random
+import threading
+import time
+import datetime
+
+from dotenv import load_dotenv
+from paste import httpserver
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server'))
+
+from server import Server, SOCKET_TIMEOUT_S, num_threads
+
+load_dotenv()
+
+BASE_SERVER_PORT = int(os.getenv('BASE_SERVER_PORT'))
+
+SEND_TIMEOUT_S = 1.0  # same as the timeout in Server._send_message
+
+
+# The network conditions of one connection (from, to), like the toxics of a toxiproxy proxy
+class Link:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.enabled = True
+        self.request_loss = 0.0
+        self.response_loss = 0.0
+        self.request_latency = None  # (delay_ms, jitter_ms)
+        self.response_latency = None
+
+    def delay(self, latency):
+        if latency is None:
+            return 0.0
+        delay_ms, jitter_ms = latency
+        return max(0.0, delay_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000.0
+
+
+class Network:
+    def __init__(self, num_servers):
+        self.num_servers = num_servers
+        self.links = {(f, t): Link() for f in range(num_servers) for t in range(num_servers)}
+
+    # connections of a server to itself are never affected (like in labs.py)
+    def other_links(self):
+        return [link for ((f, t), link) in self.links.items() if f != t]
+
+
+# A server that sends its messages through the simulated network
+class LocalServer(Server):
+    def __init__(self, ID, IP, server_list, network):
+        self.network = network  # set first, the server starts sending right away
+        super(LocalServer, self).__init__(ID, IP, server_list)
+
+    def _send_message(self, srv_ip, message, URI='/message'):
+        link = self.network.links[(self.id, self.server_list.index(srv_ip))]
+        send = super(LocalServer, self)._send_message
+
+        if not link.enabled or random.random() < link.request_loss:
+            return (False, None, None)  # the connection is refused or the request is dropped
+
+        delay = link.delay(link.request_latency)
+        if delay >= SEND_TIMEOUT_S:
+            # the request still arrives after the sender gave up
+            threading.Timer(delay, send, args=(srv_ip, message, URI)).start()
+            time.sleep(SEND_TIMEOUT_S)
+            return (False, None, None)
+        time.sleep(delay)
+
+        result = send(srv_ip, message, URI)
+
+        response_delay = link.delay(link.response_latency)
+        if delay + response_delay >= SEND_TIMEOUT_S:
+            time.sleep(SEND_TIMEOUT_S - delay)
+            return (False, None, None)
+        time.sleep(response_delay)
+
+        if random.random() < link.response_loss:
+            return (False, None, None)  # the message was handled but the response got lost
+        return result
+
+
+num_servers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+scenario_args = sys.argv[2:] if len(sys.argv) > 2 else []
+
+network = Network(num_servers)
+server_list = ["127.0.0.1:" + str(BASE_SERVER_PORT + server_id) for server_id in range(num_servers)]
+
+servers = []
+threads = num_threads(num_servers)
+for server_id in range(num_servers):
+    server = LocalServer(server_id, server_list[server_id], server_list, network)
+    http_server = httpserver.serve(server, host='127.0.0.1', port=BASE_SERVER_PORT + server_id, start_loop=False,
+                                   threadpool_workers=threads, threadpool_options={"spawn_if_under": threads},
+                                   protocol_version='HTTP/1.1', socket_timeout=SOCKET_TIMEOUT_S, daemon_threads=True)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    servers.append(server)
+
+
+# Some scenarios (same as in labs.py, bandwidth limits are not simulated)
+def clear():
+    for link in network.links.values():
+        link.clear()
+
+
+def add_partition(num_partitions=2):
+    for ((f, t), link) in network.links.items():
+        # if they are not in the same "half" we disable their connections
+        if (f - t) % num_partitions != 0:
+            link.enabled = False
+
+
+def remove_partition():
+    for link in network.links.values():
+        link.enabled = True
+
+
+def add_request_loss(p=0.1):
+    for link in network.other_links():
+        link.request_loss = p
+
+
+def add_response_loss(p=0.1):
+    for link in network.other_links():
+        link.response_loss = p
+
+
+def add_request_latency(delay_ms=1000, jitter_ms=500):
+    for link in network.other_links():
+        link.request_latency = (delay_ms, jitter_ms)
+
+
+def add_response_latency(delay_ms=1000, jitter_ms=500):
+    for link in network.other_links():
+        link.response_latency = (delay_ms, jitter_ms)
+
+
+# Unrealistic conditions, no loss, no timeouts, reorderings unlikely
+def scenario_perfect(p=0.2):
+    clear()
+
+
+# Requests might be lost entirely
+def scenario_easy(p=0.2):
+    scenario_perfect()
+    add_request_loss(p)
+
+# We have latencies on the request side, reorderings likely, requests might be lost
+def scenario_medium(p=0.2):
+    scenario_easy(p)
+    add_request_latency()
+
+# We have latencies on both sides, reorderings likely, requests and responses might be lost
+def scenario_hard(p=0.2):
+    scenario_medium(p)
+
+    add_response_loss(p)
+    add_response_latency()
+
+# Define Partitioned scenarios
+def scenario_perfect_partitioned(p=0.2, num_partitions=2):
+    scenario_perfect(p)
+    add_partition(num_partitions=num_partitions)
+
+def scenario_easy_partitioned(p=0.2, num_partitions=2):
+    scenario_easy(p)
+    add_partition(num_partitions=num_partitions)
+
+def scenario_medium_partitioned(p=0.2, num_partitions=2):
+    scenario_medium(p)
+    add_partition(num_partitions=num_partitions)
+
+def scenario_hard_partitioned(p=0.2, num_partitions=2):
+    scenario_hard(p)
+    add_partition(num_partitions=num_partitions)
+
+scenarios = {
+    "perfect": scenario_perfect,
+    "easy": scenario_easy,
+    "medium": scenario_medium,
+    "hard": scenario_hard,
+    "perfect_partitioned": scenario_perfect_partitioned,
+    "easy_partitioned": scenario_easy_partitioned,
+    "medium_partitioned": scenario_medium_partitioned,
+    "hard_partitioned": scenario_hard_partitioned,
+}
+
+def extract_scenarios_with_timeouts(scenario_args):
+    scs = []
+
+    while len(scenario_args) > 0:
+        if len(scenario_args) == 1:
+            scs.append((scenario_args[0], None))
+            break
+        else:
+            scs.append((scenario_args[0], int(scenario_args[1])))
+            scenario_args = scenario_args[2:]
+
+    # we always add the perfect scenario with no timeout in the end
+    scs.append(('perfect', None))
+    return scs
+
+
+def switch_scenario(s):
+    print("Welcome to the {} scenario".format(s))
+    # we remove existing partitions
+    remove_partition()
+    scenarios[s]()
+
+
+run_scenarios = extract_scenarios_with_timeouts(scenario_args)
+
+print("#### Started {} local servers on {}".format(num_servers, ",".join(server_list)))
+print("CTRL-C to shutdown...")
+try:
+    current_scenario = None
+    for (s, t) in run_scenarios:
+
+        if s not in scenarios:
+            print("Scenario {} not found!".format(s))
+            continue
+
+        if current_scenario is None or s != current_scenario:
+            switch_scenario(s)
+            current_scenario = s
+
+        if t is not None:
+            timeout_ts = datetime.datetime.now() + datetime.timedelta(seconds=t)
+            while timeout_ts >= datetime.datetime.now():
+                time.sleep(0.1)
+
+    # extract scenarios from stdin after iterating through all argument scenarios
+    for line in sys.stdin:
+        s = line.rstrip('\n')
+
+        if s == "shutdown":
+            break
+
+        if s not in scenarios:
+            print("Scenario {} not found!".format(s))
+            continue
+
+        if current_scenario is None or s != current_scenario:
+            switch_scenario(s)
+            current_scenario = s
+
+except KeyboardInterrupt:
+    pass
+
+# all threads of the servers are daemon threads, so the process ends here and drops the open connections
+print("Shutting down...")
+print("Finished")
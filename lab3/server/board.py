@@ -0,0 +1,198 @@
+import hashlib
+import json
+import bisect
+import zlib
+
+from vector_clock import VectorClock
+
+# whether the timestamp new_ts of an update replaces the timestamp old_ts of the current one.
+# Parallel updates are decided by comparing the clocks as lists, so all servers pick the same one
+def is_newer(old_ts, new_ts):
+    if new_ts is None:
+        return False
+    if old_ts is None or old_ts < new_ts:
+        return True
+    return old_ts.is_parallel(new_ts) and old_ts.to_list() < new_ts.to_list()
+
+class Entry:
+    def __init__(self, id, value, create_ts, modify_ts=None, delete_ts=None):
+        self.id = id
+        self.value = value
+        self.create_ts = create_ts
+        self.modify_ts = modify_ts
+        self.delete_ts = delete_ts
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "value": self.value,
+            "create_ts": self.create_ts.to_list(),
+            "modify_ts": self.modify_ts.to_list() if self.modify_ts is not None else None,
+            "delete_ts": self.delete_ts.to_list() if self.delete_ts is not None else None,
+        }
+
+    def from_dict(data: dict):
+        return Entry(data['id'], data['value'],
+                     create_ts=VectorClock.from_list(data['create_ts']),
+                     modify_ts=VectorClock.from_list(data['modify_ts']) if data['modify_ts'] else None,
+                     delete_ts=VectorClock.from_list(data['delete_ts']) if data['delete_ts'] else None
+                 )
+
+    def is_deleted(self):
+        # deletion takes simple precedence
+        return self.delete_ts is not None
+
+    # merge the state of the same entry from another server, returns True if our entry changed
+    def merge(self, other):
+        changed = False
+        if is_newer(self.modify_ts, other.modify_ts):
+            self.value = other.value
+            self.modify_ts = other.modify_ts
+            changed = True
+        if is_newer(self.delete_ts, other.delete_ts):
+            self.delete_ts = other.delete_ts
+            changed = True
+        return changed
+
+    def sort_key(self):
+        # the sum of a vector clock grows with every causally later event, so sorting by it keeps causality
+        # (a < b implies sum(a) < sum(b)) and gives a total order together with the entry ID as a tie-breaker
+        return (sum(self.create_ts.clock), self.id)
+
+    def digest(self):
+        # stable hash of the entry content, sort_keys makes it independent of dict ordering
+        return int.from_bytes(hashlib.sha256(json.dumps(self.to_dict(), sort_keys=True).encode('utf-8')).digest(), 'big')
+
+    def __str__(self):
+        return str(self.to_dict())
+
+    def __lt__(self, other):
+        # TODO: implement the sorting here! Please use the creation vector clock first to preserve causality and then use the entry ID as a tie-breaker,
+        if self.create_ts < other.create_ts:
+            return True
+        elif self.create_ts > other.create_ts:
+            return False
+        else:
+            return self.id < other.id
+        
+BOARD_HASH_MODULUS = 2 ** 256
+BUCKET_DIGEST_MODULUS = 2 ** 64
+
+# the entries are spread over ANTI_ENTROPY_BUCKETS buckets with one digest each, used by the anti-entropy of the servers
+ANTI_ENTROPY_BUCKETS = 64
+
+# You need to synchronize the access to the board when you use multithreading in the server (e.g. using a Lock)
+class Board():
+
+    # on_change(entry) is called after every change of the board (entry is None after clear()), e.g. to wake up clients
+    # waiting for changes
+    def __init__(self, on_change=None):
+        self.version = 0            # incremented on every change, also across clear()
+        self.on_change = on_change
+        self.clear()
+
+    def clear(self):
+        self.indexed_entries = {}
+        # ordered index of the non-deleted entries, kept sorted on every add so reads do not need to sort again
+        self.ordered_keys = []      # sorted list of Entry.sort_key() tuples
+        self.indexed_keys = {}      # entry id -> sort key currently stored in ordered_keys
+        # rolling hash of the non-deleted entries: the sum of the entry digests (mod 2^256) can be updated per entry.
+        # The order of the entries is fully determined by their content, so the hash does not need to include it
+        self.indexed_digests = {}   # entry id -> digest of the entry as currently indexed
+        self.board_hash = 0
+        # the same rolling hash over all entries (including deleted ones) per bucket, used for the anti-entropy
+        self.bucket_entries = [set() for _ in range(ANTI_ENTROPY_BUCKETS)]
+        self.bucket_digests = [0] * ANTI_ENTROPY_BUCKETS
+        self.tombstones = set()     # ids of the deleted entries, they are kept until purge_tombstones removes them
+        self._changed(None)
+
+    def add_entry(self, entry):
+        # TODO: Check if the entry exists already and apply update
+        self.indexed_entries[entry.id] = entry
+        self._reindex(entry)
+        self._changed(entry)
+
+    def _changed(self, entry):
+        self.version += 1
+        if self.on_change is not None:
+            self.on_change(entry)
+
+    def _reindex(self, entry):
+        old_key = self.indexed_keys.pop(entry.id, None)
+        if old_key is not None:
+            del self.ordered_keys[bisect.bisect_left(self.ordered_keys, old_key)]
+        if not entry.is_deleted():                      # deleted items are not part of the ordered index
+            key = entry.sort_key()
+            bisect.insort(self.ordered_keys, key)
+            self.indexed_keys[entry.id] = key
+        else:
+            self.tombstones.add(entry.id)
+
+        bucket = Board.bucket_of(entry.id)
+        old_digest = self.indexed_digests.get(entry.id)
+        if old_digest is not None:
+            self.bucket_digests[bucket] = (self.bucket_digests[bucket] - old_digest) % BUCKET_DIGEST_MODULUS
+            if old_key is not None:                     # only non-deleted entries are part of the board hash
+                self.board_hash = (self.board_hash - old_digest) % BOARD_HASH_MODULUS
+        else:
+            self.bucket_entries[bucket].add(entry.id)
+        digest = entry.digest()
+        self.indexed_digests[entry.id] = digest
+        self.bucket_digests[bucket] = (self.bucket_digests[bucket] + digest) % BUCKET_DIGEST_MODULUS
+        if not entry.is_deleted():
+            self.board_hash = (self.board_hash + digest) % BOARD_HASH_MODULUS
+
+    # removes the deleted entries whose delete timestamp is smaller or equal to the given clock, returns their ids.
+    # The visible board (and its hash) does not change, so this is no change for on_change
+    def purge_tombstones(self, clock):
+        purged = [entry_id for entry_id in self.tombstones if self.indexed_entries[entry_id].delete_ts.__lt_or_eq__(clock)]
+        for entry_id in purged:
+            self.remove_tombstone(entry_id)
+        return purged
+
+    def remove_tombstone(self, entry_id):
+        if entry_id not in self.tombstones:
+            return
+        del self.indexed_entries[entry_id]
+        bucket = Board.bucket_of(entry_id)
+        digest = self.indexed_digests.pop(entry_id)
+        self.bucket_digests[bucket] = (self.bucket_digests[bucket] - digest) % BUCKET_DIGEST_MODULUS
+        self.bucket_entries[bucket].discard(entry_id)
+        self.tombstones.discard(entry_id)
+
+    # entries are spread over a fixed number of buckets by their id, the same on every server
+    def bucket_of(entry_id):
+        return zlib.crc32(entry_id.encode('utf-8')) % ANTI_ENTROPY_BUCKETS
+
+    def get_bucket_digests(self):
+        return list(self.bucket_digests)
+
+    # all entries (including deleted ones) of the buckets whose digest differs from the given ones
+    def get_differing_entries(self, bucket_digests, limit=None):
+        entries = []
+        for bucket in range(ANTI_ENTROPY_BUCKETS):
+            if self.bucket_digests[bucket] != bucket_digests[bucket]:
+                entries.extend(self.indexed_entries[entry_id] for entry_id in sorted(self.bucket_entries[bucket]))  # sorted to not depend on the set order
+                if limit is not None and len(entries) >= limit:
+                    return entries[:limit]
+        return entries
+
+    # all entries (including deleted ones) with a timestamp that is not smaller or equal to the given clock
+    def get_entries_since(self, clock):
+        entries = []
+        for entry in self.indexed_entries.values():
+            for ts in (entry.create_ts, entry.modify_ts, entry.delete_ts):
+                if ts is not None and not ts.__lt_or_eq__(clock):
+                    entries.append(entry)
+                    break
+        return entries
+
+    def get_ordered_entries(self):
+        # the ordered index only contains entries that are not deleted, as they should not appear for the clients
+        return [self.indexed_entries[entry_id] for (_, entry_id) in self.ordered_keys]
+
+    def get_hash(self):
+        return format(self.board_hash, '064x')
+
+    def __len__(self):
+        return len(self.ordered_keys)
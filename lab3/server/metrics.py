@@ -0,0 +1,163 @@
+import threading
+import time
+import bisect
+
+# Minimal metrics in the Prometheus text format (no client library needed in the container).
+# Every metric has a fixed list of label names, the label values are given as keyword arguments, e.g.
+#   send_seconds = registry.histogram('send_seconds', 'Duration of a send', ['peer'])
+#   send_seconds.observe(0.01, peer='proxy:8010')
+
+# upper bounds of the histogram buckets in seconds, from 50 us to 5 s
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for (name, value) in pairs) + '}'
+
+
+class Metric():
+    type = 'untyped'
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> value
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.label_names)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, None, value) for (key, value) in self.values.items()]
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type)]
+        for (name, key, extra, value) in self.samples():
+            lines.append('{}{} {}'.format(name, format_labels(self.label_names, key, extra), float(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+# A gauge is either set directly or computed by a function when the metrics are rendered,
+# the function returns a dict label values -> value
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help, label_names=(), function=None):
+        super(Gauge, self).__init__(name, help, label_names)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, key, None, value) for (key, value) in self.function().items()]
+        return super(Gauge, self).samples()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, label_names)
+        self.buckets = tuple(buckets)
+
+    # the value of a histogram is [count per bucket (the last one is +Inf), sum, count]
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            data = self.values.get(key)
+            if data is None:
+                data = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self.values[key] = data
+            data[0][index] += 1
+            data[1] += value
+            data[2] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for (key, (counts, total, count)) in self.values.items():
+                cumulative = 0
+                for (bound, bucket_count) in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append((self.name + '_bucket', key, ('le', le), cumulative))
+                samples.append((self.name + '_sum', key, None, total))
+                samples.append((self.name + '_count', key, None, count))
+        return samples
+
+
+class Registry():
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label_names=()):
+        return self.register(Counter(self.prefix + name, help, label_names))
+
+    def gauge(self, name, help, label_names=(), function=None):
+        return self.register(Gauge(self.prefix + name, help, label_names, function))
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(self.prefix + name, help, label_names, buckets))
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+# A reentrant lock that records how long acquiring it took (in a Histogram without labels).
+# It can be used like threading.RLock, also in a threading.Condition
+class InstrumentedRLock():
+    def __init__(self, wait_seconds):
+        self._lock = threading.RLock()
+        self.wait_seconds = wait_seconds
+        # used by threading.Condition.wait to release and re-acquire all levels of the lock
+        self._release_save = self._lock._release_save
+        self._acquire_restore = self._lock._acquire_restore
+        self._is_owned = self._lock._is_owned
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._is_owned():
+            return self._lock.acquire(blocking, timeout)    # re-entrant, there is no wait to observe
+        if self._lock.acquire(False):
+            self.wait_seconds.observe(0.0)
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        self.wait_seconds.observe(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
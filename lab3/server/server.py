@@ -10,78 +10,62 @@ import json
 import hashlib
 import uuid
 import queue
+import random
 
 import requests
 import functools
 
 from vector_clock import VectorClock
-
-class Entry:
-    def __init__(self, id, value, create_ts, modify_ts=None, delete_ts=None):
-        self.id = id
-        self.value = value
-        self.create_ts = create_ts
-        self.modify_ts = modify_ts
-        self.delete_ts = delete_ts
-
-    def to_dict(self) -> dict:
-        return {
-            "id": self.id,
-            "value": self.value,
-            "create_ts": self.create_ts.to_list(),
-            "modify_ts": self.modify_ts.to_list() if self.modify_ts is not None else None,
-            "delete_ts": self.delete_ts.to_list() if self.delete_ts is not None else None,
-        }
-
-    def from_dict(data: dict):
-        return Entry(data['id'], data['value'],
-                     create_ts=VectorClock.from_list(data['create_ts']),
-                     modify_ts=VectorClock.from_list(data['modify_ts']) if data['modify_ts'] else None,
-                     delete_ts=VectorClock.from_list(data['delete_ts']) if data['delete_ts'] else None
-                 )
-
-    def is_deleted(self):
-        # deletion takes simple precedence
-        return self.delete_ts is not None
-
-    def __str__(self):
-        return str(self.to_dict())
-
-    def __lt__(self, other):
-        # TODO: implement the sorting here! Please use the creation vector clock first to preserve causality and then use the entry ID as a tie-breaker,
-        if self.create_ts < other.create_ts:
-            return True
-        elif self.create_ts > other.create_ts:
-            return False
-        else:
-            return self.id < other.id
-        
-# ------------------------------------------------------------------------------------------------------
-# You need to synchronize the access to the board when you use multithreading in the server (e.g. using a Lock)
-class Board():
-
-    def __init__(self):
-        self.indexed_entries = {}
-
-    def add_entry(self, entry):
-        # TODO: Check if the entry exists already and apply update
-        self.indexed_entries[entry.id] = entry
-
-    def get_ordered_entries(self):
-        entries = [e for e in list(self.indexed_entries.values()) if
-                   not e.is_deleted()]  # we filter out deleted items as they should not appear for the clients
-        # we then return the sorted entries
-        #return sorted(entries)
-        
-        # Task 3 sort entries based on vector clocks
-        #sorted_entries = sorted(entries, key=lambda x: (x.create_ts, x.id))
-        sorted_entries = sorted(entries)
-        return sorted_entries
+from board import Entry, Board, is_newer
+from metrics import Registry, InstrumentedRLock
+from storage import Storage
+from dedup import DedupWindow
+
+# anti-entropy: every ANTI_ENTROPY_INTERVAL_S each server compares its bucket digests with a random other server
+ANTI_ENTROPY_INTERVAL_S = 1.0
+ANTI_ENTROPY_MAX_ENTRIES = 500  # maximum number of entries shipped in one round, the rest follows in the next rounds
+
+# maximum time a GET /changes request waits for the board to change
+CHANGES_MAX_TIMEOUT_S = 30.0
+
+# outgoing messages for the same server are coalesced into one batch message (see Server.propagate)
+PROPAGATE_MAX_BATCH = 50        # maximum number of messages in one batch
+PROPAGATE_MAX_LINGER_S = 0.05   # how long a propagate thread waits for more messages before sending
+
+# failed sends are retried with exponential backoff per destination server
+RETRY_BASE_DELAY_S = 0.05
+RETRY_MAX_DELAY_S = 2.0
+
+def retry_delay(attempt):
+    # exponential backoff with jitter: a random delay between half and the full backoff
+    delay = min(RETRY_MAX_DELAY_S, RETRY_BASE_DELAY_S * (2 ** attempt))
+    return random.uniform(delay / 2, delay)
+
+# connections to other servers are kept alive and reused, at most SESSION_POOL_SIZE are kept open per server
+SESSION_POOL_SIZE = 10
+
+def create_session():
+    # urllib3 connection pools are thread-safe, so the session can be shared between threads
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=SESSION_POOL_SIZE))
+    return session
+
+def session_stats(session):
+    # number of requests sent and connections opened, every request on an already open connection is a pool hit
+    stats = {'requests': 0, 'connections': 0}
+    pools = session.get_adapter('http://').poolmanager.pools
+    for key in pools.keys():
+        stats['requests'] += pools[key].num_requests
+        stats['connections'] += pools[key].num_connections
+    stats['pool_hits'] = stats['requests'] - stats['connections']
+    return stats
 
 # ------------------------------------------------------------------------------------------------------
 class Server(Bottle):
 
-    def __init__(self, ID, IP, server_list):
+    # with start_threads=False no background threads are started, the outgoing queues then need to be handled by the caller.
+    # With a data_dir the board is stored there (see storage.py) and loaded again when the server starts
+    def __init__(self, ID, IP, server_list, start_threads=True, data_dir=None):
         super(Server, self).__init__()
         self.id = int(ID)
         self.ip = str(IP)
@@ -91,14 +75,47 @@ class Server(Bottle):
             "crashed": False,
             "notes": "",
             "num_entries": 0, # we use this to generate ids for the entries, TODO: Use lab 2 solution to generate unique ids
+            "epoch": 0,       # number of resets of the cluster, messages from an older epoch are dropped
+            "num_messages": 0, # sequence number of our last propagate/modify/delete message, the receivers drop duplicates by it
         }
         
-        # handle outgoing messages (lab 2)
-        self.queue_out = queue.Queue()
-        threading.Thread(target=self.propagate, daemon=True).start()
-
-        self.lock = threading.RLock()  # use reentry lock for the server
+        # metrics of the hot paths for GET /metrics (Prometheus text format)
+        self.metrics = Registry(prefix='blackboard_')
+        self.send_seconds = self.metrics.histogram('send_seconds', 'Duration of messages sent to other servers, including failed ones', ['peer'])
+        self.send_failures = self.metrics.counter('send_failures_total', 'Messages that could not be sent or were not answered', ['peer'])
+        self.propagate_retries = self.metrics.counter('propagate_retries_total', 'Batches that are sent again after a failure', ['peer'])
+        self.handle_message_seconds = self.metrics.histogram('handle_message_seconds', 'Time to handle a message of another server', ['type'])
+        self.list_entries_seconds = self.metrics.histogram('list_entries_seconds', 'Time to order and serialize the board for GET /entries')
+        self.metrics.gauge('queue_out_depth', 'Messages waiting in the outgoing queue', ['peer'],
+                           lambda: {(srv_ip,): queue_out.qsize() for (srv_ip, queue_out) in self.queue_out.items()})
+        self.metrics.gauge('board_entries', 'Entries on the board (not deleted)', function=lambda: {(): len(self.board)})
+        self.metrics.gauge('board_version', 'Number of changes of the board', function=lambda: {(): self.board.version})
+        self.metrics.gauge('board_tombstones', 'Deleted entries that are not purged yet', function=lambda: {(): len(self.board.tombstones)})
+        self.tombstones_purged = self.metrics.counter('tombstones_purged_total', 'Deleted entries removed by the garbage collection')
+
+        # handle outgoing messages (lab 2), every server gets its own queue and propagate thread
+        # so that a slow or partitioned server only delays the messages sent to itself
+        self.queue_out = {srv_ip: queue.Queue() for srv_ip in self.server_list}
+        # one keep-alive session per server, shared by the propagate threads and the request threads
+        self.sessions = {srv_ip: create_session() for srv_ip in self.server_list}
+        # set to cut a retry backoff short, e.g. when we hear from the server again
+        self.retry_wakeup = {srv_ip: threading.Event() for srv_ip in self.server_list}
+        self.unreachable = set()    # servers whose propagate thread is in a backoff after a failed send
+        if start_threads:
+            for srv_ip in self.server_list:
+                threading.Thread(target=self.propagate, args=(srv_ip,), daemon=True).start()
+
+        self.lock = InstrumentedRLock(self.metrics.histogram('lock_wait_seconds', 'Time spent waiting for the server lock'))  # use reentry lock for the server
         self.clock = VectorClock(n=len(self.server_list))
+        self.board_changed = threading.Condition(self.lock)  # notified on every change of the board
+
+        # tombstone garbage collection (see collect_garbage): the delivered clock tells up to which timestamp we have all
+        # changes of each server, and every server reports its delivered clock in the anti-entropy
+        self.incarnation = str(uuid.uuid4())   # new on every start: our queued messages are lost then
+        self.delivered = VectorClock(n=len(self.server_list))
+        self.peer_incarnations = {}            # server id -> incarnation whose batches we received in order
+        self.peer_delivered = {}               # server id -> delivered clock last reported by that server
+        self.message_ids = {}                  # server id -> (incarnation, DedupWindow) of the messages received from it
 
         # Handle CORS
         self.route('/<:re:.*>', method='OPTIONS', callback=self.add_cors_headers)
@@ -108,6 +125,10 @@ class Server(Bottle):
         self.post('/crash', callback=self.crash_request)
         self.post('/recover', callback=self.recover_request)
         self.get('/status', callback=self.status_request)
+        self.get('/ready', callback=self.ready_request)     # readiness probe for the lab scripts, answers as soon as the server is serving
+        self.post('/reset', callback=self.reset_request)   # clears the server, so a running cluster can be reused for the next test
+        self.get('/changes', callback=self.changes_request) # long-poll: answers as soon as the board differs from the given version
+        self.get('/metrics', callback=self.metrics_request) # Prometheus metrics, also available when crashed
 
         # Define REST URIs for the frontend (note that we define multiple update and delete routes right now)
         self.post('/entries', callback=self.create_entry_request)
@@ -117,8 +138,15 @@ class Server(Bottle):
 
         # REST URIs for our algorithms
         self.post('/message', callback=self.message_request)
+        self.post('/sync', callback=self.sync_request)                  # delta sync keyed by the vector clock of the caller
+
+        self.storage = Storage(data_dir, self.lock, self.get_stored_state) if data_dir is not None else None
+        self.board = Board(on_change=self.notify_board_changed)
+        if self.storage is not None:
+            self.load_storage(start_threads)
 
-        self.board = Board()
+        if start_threads:
+            threading.Thread(target=self.anti_entropy, daemon=True).start()
 
     # Please try to avoid modifying the following methods
     # ------------------------------------------------------------------------------------------------------
@@ -136,14 +164,16 @@ class Server(Bottle):
         try:
 
             with self.lock:
+                start = time.perf_counter()
                 ordered_entries = self.board.get_ordered_entries()
                 dict_entries = list(map(lambda entry: entry.to_dict(), ordered_entries))
+                self.list_entries_seconds.observe(time.perf_counter() - start)
 
                 return {
                     "entries": dict_entries,
                     "server_status": {
-                        "len": len(ordered_entries),
-                        "hash": hashlib.sha256((json.dumps(tuple(dict_entries)).encode('utf-8'))).hexdigest(),
+                        "len": len(self.board),
+                        "hash": self.board.get_hash(),
                         "crashed": self.status["crashed"],
                         "notes": self.status["notes"],
                         "clock": self.clock.to_list()
@@ -158,19 +188,98 @@ class Server(Bottle):
         try:
 
             with self.lock:
-                ordered_entries = self.board.get_ordered_entries()
-                dict_entries = list(map(lambda entry: entry.to_dict(), ordered_entries))
                 return {
-                    "len": len(ordered_entries),
-                    "hash": hashlib.sha256((json.dumps(tuple(dict_entries)).encode('utf-8'))).hexdigest(),
+                    "len": len(self.board),
+                    "hash": self.board.get_hash(),
                     "crashed": self.status["crashed"],
                     "notes": self.status["notes"],
-                    "clock": self.clock.to_list()
+                    "clock": self.clock.to_list(),
+                    "epoch": self.status["epoch"],
+                    "connections": {srv_ip: session_stats(session) for (srv_ip, session) in self.sessions.items()}
                 }
         except Exception as e:
             print("[ERROR] " + str(e))
             raise e
 
+    def metrics_request(self):
+        response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        return self.metrics.render()
+
+    def ready_request(self):
+        return {'id': self.id, 'ready': True}
+
+    def notify_board_changed(self, entry=None):
+        if self.storage is not None:
+            self.storage.log(entry, self.clock)
+        with self.board_changed:
+            self.board_changed.notify_all()
+
+    # GET /changes?since=<version>&timeout=<s> waits until the version of the board is not <since> anymore (or the timeout
+    # passed) and returns the current state, so clients do not need to poll /status to see when the servers converged.
+    # Like /status it also answers when crashed
+    def changes_request(self):
+        try:
+            since = int(request.query.get('since', -1))
+            timeout = min(float(request.query.get('timeout', CHANGES_MAX_TIMEOUT_S)), CHANGES_MAX_TIMEOUT_S)
+            with self.board_changed:
+                self.board_changed.wait_for(lambda: self.board.version != since, timeout)
+                return {
+                    'version': self.board.version,
+                    'len': len(self.board),
+                    'hash': self.board.get_hash(),
+                    'clock': self.clock.to_list(),
+                    'crashed': self.status['crashed']
+                }
+        except Exception as e:
+            print("[ERROR] " + str(e))
+            raise e
+
+    # POST /reset {"epoch": <epoch>} resets the whole cluster to the given epoch (see LabsControl.reset_servers),
+    # without an epoch the server moves to the next one. A server that already got there from the messages of the
+    # others (see adopt_epoch) is not reset again
+    def reset_request(self):
+        try:
+            epoch = (request.json or {}).get('epoch', self.status['epoch'] + 1)
+            self.reset_epoch(epoch)
+            self.status['crashed'] = False
+            return {'epoch': self.status['epoch']}
+        except Exception as e:
+            print("[ERROR] " + str(e))
+            raise e
+
+    # Start over with an empty board and clock in the given epoch. The epoch makes sure that messages which are
+    # still queued, retried by a propagate thread or in flight are dropped
+    def reset_epoch(self, epoch):
+        with self.lock:
+            if epoch <= self.status['epoch']:
+                return
+            self.status['epoch'] = epoch
+            self.status['num_entries'] = 0
+            self.status['num_messages'] = 0
+            for queue_out in self.queue_out.values():
+                while True:
+                    try:
+                        queue_out.get_nowait()
+                    except queue.Empty:
+                        break
+            self.board.clear()
+            self.clock.reset()
+            self.delivered.reset()
+            self.peer_incarnations.clear()
+            self.peer_delivered.clear()
+            self.message_ids.clear()
+            if self.storage is not None:
+                self.storage.log_epoch(epoch)
+        for event in self.retry_wakeup.values():
+            event.set()   # propagate threads in a backoff drop their old batch right away
+
+    # Another server is in a newer epoch, so the cluster was reset while we did not get the request (e.g. we were
+    # restarted or partitioned): we follow, otherwise we would drop all of its messages and it all of ours
+    def adopt_epoch(self, epoch):
+        if epoch is not None and epoch > self.status['epoch']:
+            print("Adopting epoch {} of another server".format(epoch))
+            self.reset_epoch(epoch)
+
     def crash_request(self):
         try:
             if not self.status["crashed"]:
@@ -183,6 +292,10 @@ class Server(Bottle):
         try:
             if self.status["crashed"]:
                 self.status["crashed"] = False
+                # catch up with everything we missed while being crashed
+                for (i, srv_ip) in enumerate(self.server_list):
+                    if i != self.id:
+                        threading.Thread(target=self.catch_up, args=(srv_ip,), daemon=True).start()
         except Exception as e:
             print("[ERROR] " + str(e))
             raise e
@@ -196,9 +309,17 @@ class Server(Bottle):
                 return None
             try:
                 # Please modify handle_message to return a response
-                return self.handle_message(request.json)
+                message = request.json
+                self.notice_reachable(message.get('sent_from'))
+                start = time.perf_counter()
+                result = self.handle_message(message)
+                self.handle_message_seconds.observe(time.perf_counter() - start, type=message['type'])
+                if result is not None and result.get('stale'):
+                    response.status = 409   # the sender keeps retrying until it learns our epoch from the response
+                return result
             except Exception as e:
                 print("[ERROR] " + str(e))
+                response.status = 500   # not handled, so the sender keeps the messages and sends them again
                 return None
         except Exception as e:
             print("[ERROR] " + str(e))
@@ -207,9 +328,9 @@ class Server(Bottle):
     # This method sends a message to another server
     # Note that it will not send a message when the server is crashed
     # Do not modify this method if not necessary
-    def _send_message(self, srv_ip, message):
+    def _send_message(self, srv_ip, message, URI='/message'):
         if self.status["crashed"]:
-            return False  # when we are crashed we do not send messages
+            return (False, None, None)  # when we are crashed we do not send messages
 
         success = False
         data = None
@@ -219,11 +340,11 @@ class Server(Bottle):
         # We always POST this message
         headers = {'Content-type': 'application/json', 'Accept': 'application/json'}
         try:
-            res = requests.post('http://{}/message'.format(srv_ip), data=json.dumps(message), headers=headers,
+            res = self.sessions[srv_ip].post('http://{}{}'.format(srv_ip, URI), data=json.dumps(message), headers=headers,
                                 timeout=1)  # timeout should stay at 1 sec
 
             # result can be accessed res.json()
-            if res.status_code == 200:
+            if res.status_code == 200 or res.status_code == 409:   # 409: the message is from an older epoch
                 data = res.json()
             if res.status_code == 200 or res.status_code == 204:
                 success = True
@@ -242,26 +363,9 @@ class Server(Bottle):
                 return
 
             entry_value = request.forms.get('value')
-            with self.lock:
-                self.status['num_entries'] += 1
-                #entry_id = self.status['num_entries']
-                unique_id = uuid.uuid4()
-                entry_id = str(unique_id)
-                with self.lock:                                 # lock incrementing own clock just in case multithreaded stuff is happening
-                    self.clock.increment(self.id)               # increment own clock (because an event happened)
-                create_ts = self.clock.copy()                   # copy current clock value to create_ts
-                entry = Entry(entry_id, entry_value, create_ts) # create new entry with create_ts
-                #entry = Entry(entry_id, str(create_ts.to_list()), create_ts) # TEST
-                self.board.add_entry(entry)                     # add new entry to board
-                # TODO: Propagate the entry to all other servers?! (based on your Lab 2 solution)
-                for other in self.server_list:
-                    message = (other, {'type': 'propagate', 'entry_value': entry_value, 'entry_id': entry_id, 'timestamp': create_ts.to_list(), 'sent_from': self.id})
-                    #message = (other, {'type': 'propagate', 'entry_value': str(create_ts.to_list()), 'entry_id': entry_id, 'timestamp': create_ts.to_list(), 'sent_from': self.id}) # TEST
-
-                    self.queue_out.put(message)
-                # TODO: Handle with vector clocks (but make sure that you lock your threads for the clock access)
-
-            return {}
+            result = self.create_entry(entry_value)
+            self.wait_durable()
+            return result
         except Exception as e:
             print("[ERROR] " + str(e))
             raise e
@@ -273,27 +377,9 @@ class Server(Bottle):
                 return
 
             entry_value = request.forms.get('value')
-            with self.lock:
-                print("Updating entry with id {} to value {}".format(entry_id, entry_value))
-                entry = self.board.indexed_entries.get(entry_id)
-                print(entry)
-                if entry is None or entry.is_deleted():                                 # check if entry exists first
-                    return {'error': 'entry does not exist or has been deleted.'}       # return error if entry doesn't exist
-                self.clock.increment(self.id)                                           # increment own clock on update event
-                entry.value = entry_value                                               # update entry value
-                entry.modify_ts = self.clock.copy()                                     # update modify timestamp to current own clock
-                #print(entry)
-                for other in self.server_list:                                          # propagate to other servers
-                    message = (other, {
-                        'type': 'modify',
-                        'entry_id': entry.id,
-                        'entry_value': entry_value,
-                        'timestamp': entry.modify_ts.to_list(),
-                        'sent_from': self.id
-                    })
-                    self.queue_out.put(message)
-
-            return {}
+            result = self.update_entry(entry_id, entry_value)
+            self.wait_durable()
+            return result
         except Exception as e:
             print("[ERROR] " + str(e))
             raise e
@@ -303,54 +389,216 @@ class Server(Bottle):
             if self.status["crashed"]:
                 response.status = 408
                 return
-            entry = self.board.indexed_entries.get(entry_id)
-            if entry is None or entry.is_deleted():                                     # check if entry exists first
-                    return {'error': 'entry does not exist or has been deleted.'}       # return error if entry doesn't exist
-            with self.lock:
-                print("Deleting entry with id {}".format(entry_id))
-                
-                self.clock.increment(self.id)                           # increase own clock
-                entry.delete_ts = self.clock.copy()                     # add current clock to entry as delete_ts
-                self.board.add_entry(entry)                             # add updated entry to board
-            
-                for other in self.server_list:
-                    message = (other, {
-                        'type': 'delete',
-                        'entry_id': entry_id,
-                        'timestamp': entry.delete_ts.to_list(),
-                        'sent_from': self.id
-                    })
-                    self.queue_out.put(message)
-
-            return {}
+
+            result = self.delete_entry(entry_id)
+            self.wait_durable()
+            return result
         except Exception as e:
             print("[ERROR] " + str(e))
             raise e
 
-    # send propagation messages from outgoing queue (lab 2)
-    def propagate(self):
+    # The following methods apply the client requests independent of bottle, so they can also be called directly (e.g. by simulation.py)
+    def create_entry(self, entry_value, entry_id=None):
+        with self.lock:
+            self.status['num_entries'] += 1
+            #entry_id = self.status['num_entries']
+            if entry_id is None:
+                unique_id = uuid.uuid4()
+                entry_id = str(unique_id)
+            with self.lock:                                 # lock incrementing own clock just in case multithreaded stuff is happening
+                self.clock.increment(self.id)               # increment own clock (because an event happened)
+            create_ts = self.clock.copy()                   # copy current clock value to create_ts
+            entry = Entry(entry_id, entry_value, create_ts) # create new entry with create_ts
+            #entry = Entry(entry_id, str(create_ts.to_list()), create_ts) # TEST
+            self.board.add_entry(entry)                     # add new entry to board
+            seq = self.next_message_seq()
+            # TODO: Propagate the entry to all other servers?! (based on your Lab 2 solution)
+            for other in self.server_list:
+                message = {'type': 'propagate', 'entry_value': entry_value, 'entry_id': entry_id, 'timestamp': create_ts.to_list(), 'sent_from': self.id, 'seq': seq}
+                #message = (other, {'type': 'propagate', 'entry_value': str(create_ts.to_list()), 'entry_id': entry_id, 'timestamp': create_ts.to_list(), 'sent_from': self.id}) # TEST
+
+                self.queue_out[other].put(message)
+            # TODO: Handle with vector clocks (but make sure that you lock your threads for the clock access)
+
+        return {'id': entry_id}  # the id lets clients (e.g. load_generator.py) modify or delete the entry later
+
+    def update_entry(self, entry_id, entry_value):
+        with self.lock:
+            print("Updating entry with id {} to value {}".format(entry_id, entry_value))
+            entry = self.board.indexed_entries.get(entry_id)
+            print(entry)
+            if entry is None or entry.is_deleted():                                 # check if entry exists first
+                return {'error': 'entry does not exist or has been deleted.'}       # return error if entry doesn't exist
+            self.clock.increment(self.id)                                           # increment own clock on update event
+            entry.value = entry_value                                               # update entry value
+            entry.modify_ts = self.clock.copy()                                     # update modify timestamp to current own clock
+            self.board.add_entry(entry)                                             # re-add so the board hash picks up the change
+            #print(entry)
+            seq = self.next_message_seq()
+            for other in self.server_list:                                          # propagate to other servers
+                message = {
+                    'type': 'modify',
+                    'entry_id': entry.id,
+                    'entry_value': entry_value,
+                    'timestamp': entry.modify_ts.to_list(),
+                    'entry': entry.to_dict(),
+                    'sent_from': self.id,
+                    'seq': seq
+                }
+                self.queue_out[other].put(message)
+
+        return {}
+
+    def delete_entry(self, entry_id):
+        entry = self.board.indexed_entries.get(entry_id)
+        if entry is None or entry.is_deleted():                                     # check if entry exists first
+                return {'error': 'entry does not exist or has been deleted.'}       # return error if entry doesn't exist
+        with self.lock:
+            print("Deleting entry with id {}".format(entry_id))
+            
+            self.clock.increment(self.id)                           # increase own clock
+            entry.delete_ts = self.clock.copy()                     # add current clock to entry as delete_ts
+            self.board.add_entry(entry)                             # add updated entry to board
+            seq = self.next_message_seq()
+
+            for other in self.server_list:
+                message = {
+                    'type': 'delete',
+                    'entry_id': entry_id,
+                    'timestamp': entry.delete_ts.to_list(),
+                    'entry': entry.to_dict(),
+                    'sent_from': self.id,
+                    'seq': seq
+                }
+                self.queue_out[other].put(message)
+
+        return {}
+
+    # send propagation messages from the outgoing queue of one server (lab 2)
+    def propagate(self, srv_ip):
+        batch = []
+        attempt = 0
+        epoch = self.status['epoch']
         while True:
-            message = self.queue_out.get()
-            result = self.send_message(message[0], message[1])
-            if result[0] == False:
-                self.queue_out.put(message)
-    
+            # all pending messages for the server are sent together, in batches of at most PROPAGATE_MAX_BATCH.
+            # A failed batch is kept and sent again (topped up with new messages) to preserve the order
+            if epoch != self.status['epoch']:
+                # the server was reset while the batch was retried, its messages belong to the old board
+                batch = []
+                attempt = 0
+            if len(batch) == 0:
+                batch.append(self.queue_out[srv_ip].get())
+                epoch = self.status['epoch']  # read before waiting for more, a reset meanwhile drops the batch
+            batch = self.collect_pending(self.queue_out[srv_ip], batch)
+            result = self.send_message(srv_ip, {'type': 'batch', 'messages': batch, 'sent_from': self.id, 'epoch': epoch, 'incarnation': self.incarnation})
+            if result[0] == True:
+                batch = []
+                attempt = 0
+                self.unreachable.discard(srv_ip)
+            else:
+                # back off before the next try, this thread does not use any CPU until then
+                self.unreachable.add(srv_ip)
+                self.propagate_retries.inc(peer=srv_ip)
+                self.retry_wakeup[srv_ip].wait(retry_delay(attempt))
+                self.retry_wakeup[srv_ip].clear()
+                attempt += 1
+
+    # add everything queued within PROPAGATE_MAX_LINGER_S to the batch
+    def collect_pending(self, queue_out, batch):
+        deadline = time.time() + PROPAGATE_MAX_LINGER_S
+        while len(batch) < PROPAGATE_MAX_BATCH:
+            try:
+                batch.append(queue_out.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return batch
+
     def send_message(self, srv_ip, message):
         # TODO: Implement your custom code here, use your solution to lab 1 to send messages between servers reliably
         # - What if the request gets lost?
         # - What if the request is delayed?
         # - What if the response gets lost?
-        return self._send_message(srv_ip, message)
-
+        start = time.perf_counter()
+        result = self._send_message(srv_ip, message)
+        self.send_seconds.observe(time.perf_counter() - start, peer=srv_ip)
+        if not result[0]:
+            self.send_failures.inc(peer=srv_ip)
+            if result[1] is not None:
+                self.adopt_epoch(result[1].get('epoch'))
+        return result
+
+
+    # a server that we could not reach sent us a message, so it can probably be reached again: its propagate thread
+    # retries right away instead of waiting for the rest of the backoff. Called once per request, not per message
+    def notice_reachable(self, sender):
+        if sender is None or sender == self.id:
+            return
+        srv_ip = self.server_list[sender]
+        if srv_ip in self.unreachable:
+            self.unreachable.discard(srv_ip)
+            self.retry_wakeup[srv_ip].set()
+
+    # every propagate/modify/delete gets the next sequence number of this server (the same for all receivers)
+    def next_message_seq(self):
+        with self.lock:
+            self.status['num_messages'] += 1
+            return self.status['num_messages']
+
+    # the sequence numbers received from the sender of a message in a batch of the given incarnation (None for messages
+    # without one). They start again with a new incarnation (after a restart), so its window is replaced
+    def get_message_ids(self, incarnation, message):
+        if 'seq' not in message:
+            return None
+        ids = self.message_ids.get(message['sent_from'])
+        if ids is None or ids[0] != incarnation:
+            ids = (incarnation, DedupWindow())
+            self.message_ids[message['sent_from']] = ids
+        return ids[1]
+
+    # messages sent before the last reset belong to the old board
+    def is_stale(self, message):
+        return message.get('epoch', self.status['epoch']) < self.status['epoch']
+
+    # the answer to a stale message, it tells the sender our epoch (answered with 409, see message_request)
+    def stale_response(self):
+        return {'stale': True, 'epoch': self.status['epoch']}
 
     # This method is called for every message received (lab 2)
     def handle_message(self, message):
         # Note that you might need to use the lock
-        print("Received message: ", message)
         type = message['type']
+        if type == 'batch':    # the messages inside are printed one by one when they are handled
+            seqs = [m.get('seq') for m in message['messages']]
+            print("Received batch from {}: {} messages, seq {}..{}".format(message.get('sent_from'), len(seqs), seqs[0] if seqs else None, seqs[-1] if seqs else None))
+        elif type != 'sync':   # anti-entropy requests arrive every second and would flood the log
+            print("Received message: ", message)
         
+        self.adopt_epoch(message.get('epoch'))
+        if self.is_stale(message):
+            return self.stale_response()
+
+        # batch message from the propagate thread of another server, handle every message on its own
+        if type == 'batch':
+            with self.lock:     # a reset can not happen while the batch is handled
+                if self.is_stale(message):
+                    return self.stale_response()
+                # the batches of one incarnation arrive in the order they were queued
+                in_order = message.get('incarnation') is not None and self.peer_incarnations.get(message['sent_from']) == message['incarnation']
+                results = []
+                for m in message['messages']:
+                    ids = self.get_message_ids(message.get('incarnation'), m)
+                    if ids is not None and m['seq'] in ids:
+                        results.append({})  # sent again because a response got lost, it was already applied
+                        continue
+                    results.append(self.handle_message(m))
+                    if ids is not None:
+                        ids.add(m['seq'])   # only now, a message that failed is applied when it is sent again
+                    if in_order:
+                        self.mark_delivered(m)
+                return {'results': results}
+
         # propagation message: add entry to board  Task 2
-        if type == 'propagate':
+        elif type == 'propagate':
                 entry_value = message['entry_value']
                 entry_id = message['entry_id']
                 if len(message['timestamp']) == len(self.clock.to_list()):                      # check if both clocks are same length (same number of servers for both clocks)
@@ -360,6 +608,8 @@ class Server(Bottle):
                         if not self.id == message['sent_from']:
                             self.clock.increment(self.id)                                       # increment own clock
                         self.clock.update(entry_timestamp)                                      # update own clock
+                        if entry_id in self.board.indexed_entries or self.is_purged(entry_timestamp):
+                            return {}                                                           # already known, e.g. through the anti-entropy
                         self.status['num_entries'] += 1
                         entry = Entry(entry_id, entry_value, entry_timestamp)
                         self.board.add_entry(entry)
@@ -369,13 +619,17 @@ class Server(Bottle):
             modify_ts = VectorClock.from_list(entries = message['timestamp'])
             entry_value = message['entry_value']
             entry = self.board.indexed_entries.get(entry_id)
+            if entry is None and 'entry' in message:
+                # the create of another server has not arrived yet, the message has the whole entry
+                self.merge_entries([message['entry']])
+                return {}
             if entry is None or entry.is_deleted():
                 return {'error': 'entry does not exist or has been deleted.'}
             with self.lock:
                 if not self.id == message['sent_from']:
                     self.clock.increment(self.id)
                 self.clock.update(modify_ts)
-                if entry.modify_ts is None or entry.modify_ts < modify_ts:
+                if is_newer(entry.modify_ts, modify_ts):
                     entry.value = entry_value
                     entry.modify_ts = modify_ts
                     self.board.add_entry(entry)
@@ -384,35 +638,240 @@ class Server(Bottle):
             entry_id = message['entry_id']
             delete_ts = VectorClock.from_list(entries = message['timestamp'])
             entry = self.board.indexed_entries.get(entry_id)
+            if entry is None and 'entry' in message:
+                self.merge_entries([message['entry']])
+                return {}
             if entry is None or entry.is_deleted():
                 return {'error': 'entry does not exist or has been deleted.'}
             with self.lock:
                 if not self.id == message['sent_from']:
                     self.clock.increment(self.id)                               # entry already deleted on self
                 self.clock.update(delete_ts)
-                if entry.delete_ts is None or entry.delete_ts < delete_ts:
+                if is_newer(entry.delete_ts, delete_ts):
                     entry.delete_ts = delete_ts
                     self.board.add_entry(entry)
 
+        # anti-entropy request: send back what differs from the bucket digests of the other server
+        elif type == 'sync':
+            with self.lock:
+                self.learn_delivered(message)
+                entries = self.board.get_differing_entries(message['buckets'], limit=ANTI_ENTROPY_MAX_ENTRIES)
+                return {
+                    'entries': [entry.to_dict() for entry in entries],
+                    'buckets': self.board.get_bucket_digests(),
+                    'clock': self.clock.to_list(),
+                    'delivered': self.get_delivered(),
+                    'incarnation': self.incarnation,
+                    'epoch': self.status['epoch'],
+                    'sent_from': self.id
+                }
+
+        # anti-entropy push: entries the other server has and we might be missing
+        elif type == 'sync_entries':
+            with self.lock:
+                if not self.is_stale(message):
+                    self.merge_entries(message['entries'])
+
         else:
             print("Received weird message?")
 
         return {}
 
-# Sleep a bit to allow logging to be attached
-time.sleep(2)
-
-# the server_list contains all server ips of the distributed blackboard
-server_list = os.getenv('SERVER_LIST').split(',')
-own_id = int(os.getenv('SERVER_ID'))
-own_ip = server_list[own_id]
-
-server = Server(own_id, own_ip, server_list)
-
-NUM_THREADS = 10
-print("#### Starting Server {} with {} threads".format(str(own_id), NUM_THREADS))
-httpserver.serve(server, host='0.0.0.0', port=80, threadpool_workers=NUM_THREADS,
-                 threadpool_options={"spawn_if_under": NUM_THREADS})
-
+    # anti-entropy (lab 3): the propagate threads only retry what is still queued, so we periodically compare
+    # our board with a random other server. Both exchange their clock and bucket digests and only the entries
+    # of differing buckets are shipped, so healing a partition costs time proportional to the difference
+    def anti_entropy(self):
+        others = [srv_ip for (i, srv_ip) in enumerate(self.server_list) if i != self.id]
+        while True:
+            time.sleep(ANTI_ENTROPY_INTERVAL_S)
+            if len(others) == 0 or self.status['crashed']:
+                continue
+            try:
+                self.sync_with(random.choice(others))
+                self.collect_garbage()
+            except Exception as e:
+                print("[ERROR] " + str(e))
 
+    def sync_with(self, srv_ip):
+        with self.lock:
+            message = {'type': 'sync', 'buckets': self.board.get_bucket_digests(), 'clock': self.clock.to_list(), 'sent_from': self.id, 'epoch': self.status['epoch'],
+                       'delivered': self.get_delivered(), 'incarnation': self.incarnation}
+        success, data, _ = self.send_message(srv_ip, message)
+        if not success or data is None or 'entries' not in data:
+            return
+        self.adopt_epoch(data.get('epoch'))
+        if self.is_stale(message):
+            return  # reset meanwhile, the entries belong to the old board
+        self.merge_entries(data['entries'])
+
+        # whatever still differs (or the other server has not seen according to its clock) is pushed back
+        with self.lock:
+            self.learn_delivered(data)
+            other_clock = VectorClock.from_list(data['clock'])
+            if self.board.get_bucket_digests() == data['buckets'] and self.clock.__lt_or_eq__(other_clock):
+                return
+            entries = self.board.get_differing_entries(data['buckets'], limit=ANTI_ENTROPY_MAX_ENTRIES)
+        if len(entries) > 0:
+            self.send_message(srv_ip, {'type': 'sync_entries', 'entries': [entry.to_dict() for entry in entries], 'sent_from': self.id, 'epoch': self.status['epoch']})
+
+    # Tombstone garbage collection by causal stability: a deleted entry is purged once every server has the delete.
+    # The clock of a server does not tell that (the anti-entropy ships entries out of order), so every server keeps a
+    # delivered clock: component k is the highest timestamp of server k up to which we have all changes of server k.
+    # It grows with the batches of server k (they arrive in order, see propagate) and whenever our board equals the
+    # board of server k in the anti-entropy. The minimum of the delivered clocks of all servers is the stable clock:
+    # every server has all changes up to it, so a delete_ts <= stable clock is known everywhere, and an unknown entry
+    # with a create_ts <= stable clock was purged by us and must not be added again
+
+    # our delivered clock, we have all of our own changes
+    def get_delivered(self):
+        delivered = self.delivered.to_list()
+        delivered[self.id] = self.clock.to_list()[self.id]
+        return delivered
+
+    # a message of server k from its batches: we now have its changes up to its timestamp
+    def mark_delivered(self, message):
+        sender = message.get('sent_from')
+        timestamp = message.get('timestamp')
+        if sender is None or sender == self.id or timestamp is None or len(timestamp) != len(self.server_list):
+            return
+        self.delivered.update(VectorClock.from_list([timestamp[sender] if i == sender else 0 for i in range(len(self.server_list))]))
+
+    # sync request or response of another server (with the server lock held)
+    def learn_delivered(self, message):
+        sender = message['sent_from']
+        self.peer_delivered[sender] = message['delivered']
+        if message['buckets'] == self.board.get_bucket_digests():
+            # our board equals the board the server had at this clock, so we have all its changes up to there.
+            # From now on we also count its batches (they only contain later changes)
+            self.peer_incarnations[sender] = message['incarnation']
+            self.mark_delivered({'sent_from': sender, 'timestamp': message['clock']})
+
+    def get_stable_clock(self):
+        if len(self.peer_delivered) < len(self.server_list) - 1:
+            return None
+        stable = self.get_delivered()
+        for delivered in self.peer_delivered.values():
+            stable = list(map(min, stable, delivered))
+        return VectorClock.from_list(stable)
+
+    def is_purged(self, create_ts):
+        stable = self.get_stable_clock()
+        return stable is not None and create_ts.__lt_or_eq__(stable)
+
+    def collect_garbage(self):
+        with self.lock:
+            stable = self.get_stable_clock()
+            if stable is not None:
+                purged = self.board.purge_tombstones(stable)
+                self.tombstones_purged.inc(len(purged))
+                if self.storage is not None:
+                    for entry_id in purged:
+                        self.storage.log_purge(entry_id)
+
+    # server to server delta sync: returns all entries with a create, modify or delete timestamp that is not
+    # covered by the clock of the caller. Unlike /entries this also contains deleted entries and handles the crashed state
+    def sync_request(self):
+        try:
+            if self.status["crashed"]:
+                response.status = 408
+                return None
+            self.adopt_epoch(request.json.get('epoch'))
+            if self.is_stale(request.json):
+                response.status = 409
+                return self.stale_response()
+            clock = VectorClock.from_list(request.json['clock'])
+            with self.lock:
+                return {
+                    'entries': [entry.to_dict() for entry in self.board.get_entries_since(clock)],
+                    'clock': self.clock.to_list(),
+                    'epoch': self.status['epoch']
+                }
+        except Exception as e:
+            print("[ERROR] " + str(e))
+            raise e
 
+    # fetch everything we have not seen yet from another server in a single round trip (e.g. after recovering).
+    # Our clock can be ahead of entries we miss (the anti-entropy ships entries out of order), the delivered clock is not
+    def catch_up(self, srv_ip):
+        with self.lock:
+            clock = self.get_delivered()
+            epoch = self.status['epoch']
+        success, data, _ = self._send_message(srv_ip, {'clock': clock, 'epoch': epoch}, URI='/sync')
+        if data is not None:
+            self.adopt_epoch(data.get('epoch'))
+        if success and data is not None and data.get('epoch') == self.status['epoch'] == epoch:
+            self.merge_entries(data['entries'])
+
+    # a client only gets its answer once its change is on disk (called without the server lock, the storage writes
+    # the changes of all waiting clients with one fsync)
+    def wait_durable(self):
+        if self.storage is not None:
+            self.storage.wait_flushed()
+
+    # the state for a snapshot of the storage
+    def get_stored_state(self):
+        return [entry.to_dict() for entry in self.board.indexed_entries.values()], self.clock.to_list(), self.status['epoch']
+
+    # restore the board and clock from the storage, the rest comes from the other servers (catch up and anti-entropy)
+    def load_storage(self, catch_up=True):
+        start = time.perf_counter()
+        dict_entries, clocks, epoch, purged = self.storage.load()
+        with self.lock:
+            self.status['epoch'] = epoch
+            self.merge_entries(dict_entries)
+            for entry_id in purged:
+                self.board.remove_tombstone(entry_id)
+            for clock in clocks:
+                if len(clock) == len(self.server_list):
+                    self.clock.update(VectorClock.from_list(clock))
+        self.storage.start()
+        print("Loaded {} entries from the storage in {:.3f} s".format(len(self.board), time.perf_counter() - start))
+        if not catch_up:
+            return
+        for (i, srv_ip) in enumerate(self.server_list):
+            if i != self.id:
+                threading.Thread(target=self.catch_up, args=(srv_ip,), daemon=True).start()
+
+    def merge_entries(self, dict_entries):
+        with self.lock:
+            stable = self.get_stable_clock()
+            for data in dict_entries:
+                remote = Entry.from_dict(data)
+                if len(remote.create_ts.to_list()) != len(self.clock.to_list()):
+                    continue
+                entry = self.board.indexed_entries.get(remote.id)
+                if entry is None:
+                    if stable is not None and remote.create_ts.__lt_or_eq__(stable):
+                        continue    # purged tombstone that another server did not purge yet
+                    self.status['num_entries'] += 1
+                    entry = remote
+                elif not entry.merge(remote):
+                    continue
+                for ts in (remote.create_ts, remote.modify_ts, remote.delete_ts):
+                    if ts is not None:
+                        self.clock.update(ts)
+                self.board.add_entry(entry)
+
+NUM_THREADS = 10  # worker threads for clients, e.g. watchers of GET /changes
+SOCKET_TIMEOUT_S = 5  # idle keep-alive connections are closed after this, so they do not hold a worker thread forever
+
+# every other server keeps up to two connections to us alive (propagate and anti-entropy), each holds a worker thread
+def num_threads(num_servers):
+    return NUM_THREADS + 2 * (num_servers - 1)
+
+# the server is only started when this file is executed, so Server can also be imported (e.g. by local_cluster.py)
+if __name__ == "__main__":
+    # the server_list contains all server ips of the distributed blackboard
+    server_list = os.getenv('SERVER_LIST').split(',')
+    own_id = int(os.getenv('SERVER_ID'))
+    own_ip = server_list[own_id]
+
+    # set DATA_DIR (e.g. to a mounted volume) to keep the board across restarts of the container
+    server = Server(own_id, own_ip, server_list, data_dir=os.getenv('DATA_DIR'))
+
+    threads = num_threads(len(server_list))
+    print("#### Starting Server {} with {} threads".format(str(own_id), threads))
+    # HTTP/1.1 keeps the connections of the other servers alive between messages
+    httpserver.serve(server, host='0.0.0.0', port=80, threadpool_workers=threads,
+                     threadpool_options={"spawn_if_under": threads}, protocol_version='HTTP/1.1',
+                     socket_timeout=SOCKET_TIMEOUT_S)
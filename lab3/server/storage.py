@@ -0,0 +1,204 @@
+import json
+import os
+import threading
+import time
+
+# Durable storage of the board: every change of an entry is appended to a write-ahead log (one JSON line with the full
+# state of the entry and the clock of the server), and from time to time the whole board is written as a snapshot.
+# The records contain full entry states, so replaying them (also twice) with Entry.merge gives the same board again.
+# Tombstones removed by the garbage collection get a purge record, so they do not come back with the next load.
+#
+# The epoch of the server is stored too (in the snapshot and as a record of its own after a reset), so a restarted
+# server does not fall back to epoch 0.
+#
+# files in the data directory:
+#   snapshot.json  board entries, clock and epoch at the time of the snapshot
+#   wal.log        changes since the snapshot
+#   wal.old        changes of the previous log while a snapshot is written (only exists if we stopped right then)
+
+WAL_FLUSH_INTERVAL_S = 0.01      # changes are written and fsynced in groups, at most this long after they happened
+SNAPSHOT_EVERY_RECORDS = 10000   # write a snapshot (and start a new log) after this many records
+
+
+class Storage():
+    # get_state returns (list of entry dicts, clock list, epoch) and is called with server_lock held
+    def __init__(self, data_dir, server_lock, get_state):
+        self.data_dir = data_dir
+        self.server_lock = server_lock
+        self.get_state = get_state
+        self.lock = threading.Lock()   # protects pending and the log file
+        self.pending = []              # serialized records that are not written yet
+        self.records = 0               # records in the current log
+        self.generation = 0            # incremented by clear(), a snapshot of an older generation is not stored anymore
+        self.wal = None                # None until start(), changes before that (e.g. while loading) are not logged
+        self.wal_size = 0              # bytes of wal.log up to the last complete record, found by load()
+        self.logged = 0                # number of records passed to the storage so far
+        self.flushed = 0               # number of those records that are on disk (or not needed anymore)
+        self.flushed_changed = threading.Condition(self.lock)
+
+        os.makedirs(data_dir, exist_ok=True)
+        self.snapshot_path = os.path.join(data_dir, 'snapshot.json')
+        self.wal_path = os.path.join(data_dir, 'wal.log')
+        self.old_wal_path = os.path.join(data_dir, 'wal.old')
+
+    # returns (list of entry dicts, list of clocks, epoch, set of purged entry ids), entries and clocks in the order
+    # they were written: the snapshot first, then the logs
+    def load(self):
+        entries = []
+        clocks = []
+        epoch = 0
+        purged = set()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as file:
+                snapshot = json.load(file)
+            entries.extend(snapshot['entries'])
+            clocks.append(snapshot['clock'])
+            epoch = snapshot.get('epoch', 0)
+        for path in (self.old_wal_path, self.wal_path):
+            if not os.path.exists(path):
+                continue
+            size = 0
+            with open(path, 'rb') as file:
+                for line in file:
+                    # the last line might be incomplete if we stopped while writing it. A record without its newline
+                    # is incomplete too: its group was not fsynced yet, and the next write would append to the same line
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    size += len(line)
+                    if 'epoch' in record:
+                        epoch = record['epoch']
+                    elif 'purge' in record:
+                        purged.add(record['purge'])
+                    else:
+                        entries.append(record['entry'])
+                        clocks.append(record['clock'])
+            if path == self.wal_path:
+                self.wal_size = size
+        return entries, clocks, epoch, purged
+
+    # called after load() when the loaded state is on the board
+    def start(self):
+        # the state is read first: the server lock is always taken before self.lock
+        state = None
+        if os.path.exists(self.old_wal_path):
+            with self.server_lock:
+                state = self.get_state()
+        with self.lock:
+            self.wal = open(self.wal_path, 'a')
+            # an incomplete last record is cut off, otherwise the records appended after it would be lost with it
+            self.wal.truncate(self.wal_size)
+            if state is not None:
+                # we stopped while writing a snapshot, both logs are loaded now so we write the snapshot again
+                entries, clock, epoch = state
+                self.write_snapshot(entries, clock, epoch)
+                os.remove(self.old_wal_path)
+                self.wal.truncate(0)
+        threading.Thread(target=self.flush_loop, daemon=True).start()
+
+    # called for every change of the board (with the server lock held), entry is None if the board was cleared
+    def log(self, entry, clock):
+        if self.wal is None:
+            return
+        if entry is None:
+            self.clear()
+            return
+        self.append(json.dumps({'entry': entry.to_dict(), 'clock': clock.to_list()}))
+
+    # called for every tombstone removed by the garbage collection (with the server lock held)
+    def log_purge(self, entry_id):
+        if self.wal is None:
+            return
+        self.append(json.dumps({'purge': entry_id}))
+
+    # called after the board was cleared by a reset (with the server lock held)
+    def log_epoch(self, epoch):
+        if self.wal is None:
+            return
+        self.append(json.dumps({'epoch': epoch}))
+
+    def append(self, record):
+        with self.lock:
+            self.pending.append(record)
+            self.logged += 1
+
+    # waits until all records passed to the storage so far are on disk, e.g. before a client gets its answer
+    def wait_flushed(self):
+        with self.lock:
+            if self.wal is None:
+                return
+            logged = self.logged
+            self.flushed_changed.wait_for(lambda: self.flushed >= logged)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.pending = []
+            self.set_flushed()  # the cleared records do not need to be written anymore
+            self.records = 0
+            self.wal.truncate(0)
+            for path in (self.snapshot_path, self.old_wal_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def flush_loop(self):
+        while True:
+            time.sleep(WAL_FLUSH_INTERVAL_S)
+            try:
+                with self.lock:
+                    self.write_pending()
+                if self.records >= SNAPSHOT_EVERY_RECORDS:
+                    self.snapshot()
+            except Exception as e:
+                print("[ERROR] " + str(e))
+
+    # write all pending records with a single fsync (needs self.lock)
+    def write_pending(self):
+        if len(self.pending) == 0:
+            return
+        self.wal.write('\n'.join(self.pending) + '\n')
+        self.wal.flush()
+        os.fsync(self.wal.fileno())
+        self.records += len(self.pending)
+        self.pending = []
+        self.set_flushed()
+
+    # all records logged so far are written (needs self.lock)
+    def set_flushed(self):
+        self.flushed = self.logged
+        self.flushed_changed.notify_all()
+
+    def snapshot(self):
+        # take the state and start a new log at the same time, so every change is either in the snapshot or in the new log
+        with self.server_lock:
+            entries, clock, epoch = self.get_state()
+            with self.lock:
+                generation = self.generation
+                self.write_pending()  # into the old log, clients may be waiting for them
+                self.wal.close()
+                os.replace(self.wal_path, self.old_wal_path)
+                self.wal = open(self.wal_path, 'a')
+                self.records = 0
+
+        # writing the snapshot does not block the server
+        tmp_path = self.write_snapshot(entries, clock, epoch, replace=False)
+        with self.lock:
+            if generation != self.generation:
+                os.remove(tmp_path)  # the board was cleared meanwhile
+                return
+            os.replace(tmp_path, self.snapshot_path)
+            os.remove(self.old_wal_path)
+
+    # writes the snapshot to a temporary file first, so there is always a complete snapshot
+    def write_snapshot(self, entries, clock, epoch, replace=True):
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'entries': entries, 'clock': clock, 'epoch': epoch}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        if replace:
+            os.replace(tmp_path, self.snapshot_path)
+        return tmp_path
@@ -1,40 +1,42 @@
 from typing import Self
-from functools import total_ordering
-import copy
+import operator
 
+# The entries are stored in an immutable tuple: copies can share it and every change replaces the tuple
+# (copy-on-write), so copy, from_list and comparisons do not need to deepcopy lists anymore
 class VectorClock():
+    __slots__ = ('clock',)
+
     def __init__(self, n=1, entries=None):
         # TODO: Init vector clock with num and integer entries, you might want to create a copy of the entries
         if entries == None:
-            self.clock = [0] * n
+            self.clock = (0,) * n
         elif len(entries) == n:
-            self.clock = copy.deepcopy(entries)
+            self.clock = tuple(entries)
         else:
             raise ValueError(f"length of entries must be {n}")
-        pass
 
     # TODO: Increment the respective clock index when an event occurs on server i
     def increment(self, i):
-        self.clock[i] += 1
-        pass
+        clock = self.clock
+        self.clock = clock[:i] + (clock[i] + 1,) + clock[i + 1:]
+
+    def reset(self):
+        self.clock = (0,) * len(self.clock)
 
     # TODO: Update our own entries based on the other clock
     def update(self, other: Self):
-        for i in range(len(self.clock)):
-            self.clock[i] = max(self.clock[i], other.clock[i])
-        pass
+        self.clock = tuple(map(max, self.clock, other.clock))
 
     # Todo: Implement me
     @classmethod
     def from_list(cls, entries : list) -> Self:
-        vectorclock = cls()
-        vectorclock.clock = copy.deepcopy(entries)
-        vectorclock.n = len(entries)
+        vectorclock = cls.__new__(cls)
+        vectorclock.clock = tuple(entries)
         return vectorclock
 
     # Todo: Implement me
     def to_list(self) -> list:
-        return copy.deepcopy(self.clock)
+        return list(self.clock)
 
     # Todo: Implement me
     # two clocks are parallel when neither has entries that are all smaller or equal to the other?
@@ -47,33 +49,26 @@ class VectorClock():
 
     # Todo: Implement me
     # self strictly smaller than other (compare each pair of entries)
-    @total_ordering
     def __lt__(self, other):
-        # TODO: implement me if our clock is strictly smaller than the other one!
-        for s, o in zip(self.clock, other.clock):
-            if s > o:
-                return False
-        # at least one entry in self strictly smaller than other
-        for s, o in zip(self.clock, other.clock):
-            if s < o:
-                return True
-        return False
-    
+        # all entries smaller or equal and at least one entry in self strictly smaller than other
+        return self.clock != other.clock and all(map(operator.le, self.clock, other.clock))
+
     # self less than or equal to other (compare each pair of entries)
     def __lt_or_eq__(self, other):
-        for s, o in zip(self.clock, other.clock):
-            if s > o:
-                return False
-        return True
+        return all(map(operator.le, self.clock, other.clock))
+
+    def __eq__(self, other):
+        return isinstance(other, VectorClock) and self.clock == other.clock
+
+    def __hash__(self):
+        return hash(self.clock)
 
-    # a simple copy function for now
+    # copies share the (immutable) entries
     def copy(self : Self) -> Self:
-        entries = self.to_list()
-        copyClock = VectorClock(len(entries), entries)
-        return copyClock
+        return VectorClock.from_list(self.clock)
     
     def __str__(self):
-        return f"VectorClock({self.clock})"
+        return f"VectorClock({list(self.clock)})"
 
 
 if __name__ == "__main__":
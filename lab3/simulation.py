@@ -0,0 +1,273 @@
+# Deterministic discrete-event simulation of the servers (no docker, no sockets, no threads).
+# The real Server code (create_entry/update_entry/delete_entry, handle_message, sync_with) is driven by a virtual clock:
+# the propagate threads are replaced by simulated lanes that take the batches from queue_out and deliver them
+# through a seeded network model with the same loss/latency/partition scenarios as labs.py and local_cluster.py.
+# A run only takes as long as the computation, and the same seed always gives the same result.
+#
+# usage: python3 simulation.py [runs per configuration] [first seed]
+# the results of the sweep are written to logs/simulation_log_<date>.csv
+
+import os
+import sys
+import contextlib
+import heapq
+import random
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server'))
+
+from server import Server, retry_delay, ANTI_ENTROPY_INTERVAL_S, PROPAGATE_MAX_BATCH, PROPAGATE_MAX_LINGER_S
+
+SEND_TIMEOUT_S = 1.0       # same as the timeout in Server._send_message
+MAX_VIRTUAL_TIME_S = 600   # a run that has not converged by then counts as not converged
+
+RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+FIRST_SEED = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+
+SERVER_COUNTS = [2, 4, 8]
+ENTRY_COUNTS = [10, 100]
+SCENARIOS = ["perfect", "easy", "medium", "hard", "easy_partitioned"]
+
+
+# The network conditions of one connection (from, to), like the toxics of a toxiproxy proxy
+class Link:
+    def __init__(self):
+        self.enabled = True
+        self.request_loss = 0.0
+        self.response_loss = 0.0
+        self.request_latency = None  # (delay_ms, jitter_ms)
+        self.response_latency = None
+
+
+# Same scenarios as in labs.py (bandwidth limits are not simulated)
+def create_links(num_servers, scenario, p=0.2, num_partitions=2):
+    links = {(f, t): Link() for f in range(num_servers) for t in range(num_servers)}
+    for ((f, t), link) in links.items():
+        if f == t:
+            continue
+        if scenario.startswith(("easy", "medium", "hard")):
+            link.request_loss = p
+        if scenario.startswith(("medium", "hard")):
+            link.request_latency = (1000, 500)
+        if scenario.startswith("hard"):
+            link.response_loss = p
+            link.response_latency = (1000, 500)
+    return links
+
+
+def partition(links, num_partitions=2):
+    for ((f, t), link) in links.items():
+        # if they are not in the same "half" we disable their connections
+        if (f - t) % num_partitions != 0:
+            link.enabled = False
+
+
+# A server whose direct sends (anti-entropy) are answered synchronously by the target, only loss and partitions apply
+class SimServer(Server):
+    def __init__(self, ID, IP, server_list, simulation):
+        self.simulation = simulation
+        super(SimServer, self).__init__(ID, IP, server_list, start_threads=False)
+
+    def _send_message(self, srv_ip, message, URI='/message'):
+        if self.status['crashed']:
+            return (False, None, None)
+        target_id = self.server_list.index(srv_ip)
+        link = self.simulation.links[(self.id, target_id)]
+        rng = self.simulation.rng
+        if not link.enabled or rng.random() < link.request_loss:
+            return (False, None, None)
+        data = self.simulation.servers[target_id].handle_message(message)
+        if rng.random() < link.response_loss:
+            return (False, None, None)
+        if data is not None and data.get('stale'):
+            return (False, data, None)  # answered with 409 over HTTP
+        return (True, data, None)
+
+
+class Simulation:
+    def __init__(self, num_servers, num_entries, scenario, seed, anti_entropy=True, partition_duration_s=5.0):
+        self.rng = random.Random(seed)
+        random.seed(seed)  # used by the server for the retry jitter and the anti-entropy partner
+
+        self.now = 0.0
+        self.events = []
+        self.counter = 0  # tie-breaker so that events at the same time run in insertion order
+
+        self.num_entries = num_entries
+        self.links = create_links(num_servers, scenario)
+        self.server_list = ["sim:" + str(server_id) for server_id in range(num_servers)]
+        self.servers = [SimServer(server_id, self.server_list[server_id], self.server_list, self)
+                        for server_id in range(num_servers)]
+
+        # one lane per (from, to), replaces the propagate thread of the server
+        self.lanes = {(f, t): {'batch': [], 'attempt': 0, 'busy': False}
+                      for f in range(num_servers) for t in range(num_servers)}
+
+        self.created = 0
+        self.deleted = set()
+        self.messages = 0
+        self.workload_done = False
+
+        if scenario.endswith("_partitioned"):
+            partition(self.links)
+            self.schedule(partition_duration_s, self.heal_partition)
+        if anti_entropy:
+            for server_id in range(num_servers):
+                # the servers start their rounds at different offsets
+                self.schedule(self.rng.uniform(0, ANTI_ENTROPY_INTERVAL_S), self.anti_entropy_round, server_id)
+
+    def schedule(self, delay, fn, *args):
+        self.counter += 1
+        heapq.heappush(self.events, (self.now + delay, self.counter, fn, args))
+
+    def delay(self, latency):
+        if latency is None:
+            return 0.0
+        delay_ms, jitter_ms = latency
+        return max(0.0, delay_ms + self.rng.uniform(-jitter_ms, jitter_ms)) / 1000.0
+
+    def heal_partition(self):
+        for link in self.links.values():
+            link.enabled = True
+
+    # --- the workload: creates spread over the servers, then some modifies and deletes of visible entries
+    def create_workload(self, interval_s=0.01):
+        num_servers = len(self.servers)
+        for i in range(self.num_entries):
+            self.schedule(i * interval_s, self.client_create, i % num_servers, i)
+        num_changes = max(1, self.num_entries // 10)
+        start = self.num_entries * interval_s
+        for i in range(num_changes):
+            self.schedule(start + i * interval_s, self.client_change, self.rng.randrange(num_servers), i)
+        self.schedule(start + num_changes * interval_s, self.finish_workload)
+
+    def client_create(self, server_id, i):
+        self.servers[server_id].create_entry("value " + str(i), entry_id="entry-" + str(i))
+        self.created += 1
+        self.kick_lanes(server_id)
+
+    def client_change(self, server_id, i):
+        server = self.servers[server_id]
+        entries = server.board.get_ordered_entries()
+        if len(entries) == 0:
+            return
+        entry = entries[self.rng.randrange(len(entries))]
+        if i % 2 == 0:
+            server.update_entry(entry.id, "modified " + str(i))
+        else:
+            server.delete_entry(entry.id)
+            self.deleted.add(entry.id)
+        self.kick_lanes(server_id)
+
+    def finish_workload(self):
+        self.workload_done = True
+
+    # --- the lanes: like Server.propagate, but every step is an event
+    def kick_lanes(self, server_id):
+        for t in range(len(self.servers)):
+            lane = self.lanes[(server_id, t)]
+            if not lane['busy']:
+                lane['busy'] = True
+                self.schedule(PROPAGATE_MAX_LINGER_S, self.send_batch, server_id, t)
+
+    def send_batch(self, f, t):
+        lane = self.lanes[(f, t)]
+        queue_out = self.servers[f].queue_out[self.server_list[t]]
+        while len(lane['batch']) < PROPAGATE_MAX_BATCH and not queue_out.empty():
+            lane['batch'].append(queue_out.get_nowait())
+        if len(lane['batch']) == 0:
+            lane['busy'] = False
+            return
+
+        self.messages += 1
+        message = {'type': 'batch', 'messages': list(lane['batch']), 'sent_from': f, 'incarnation': self.servers[f].incarnation}
+        link = self.links[(f, t)]
+        if f != t and (not link.enabled or self.rng.random() < link.request_loss):
+            self.schedule(0, self.batch_done, f, t, False)
+            return
+
+        delay = self.delay(link.request_latency)
+        self.schedule(delay, self.servers[t].handle_message, message)
+        if delay >= SEND_TIMEOUT_S:
+            # the request still arrives after the sender gave up
+            self.schedule(SEND_TIMEOUT_S, self.batch_done, f, t, False)
+            return
+        response_delay = self.delay(link.response_latency)
+        if delay + response_delay >= SEND_TIMEOUT_S:
+            self.schedule(SEND_TIMEOUT_S, self.batch_done, f, t, False)
+        else:
+            # the message was handled, but the response might still get lost
+            self.schedule(delay + response_delay, self.batch_done, f, t, self.rng.random() >= link.response_loss)
+
+    def batch_done(self, f, t, success):
+        lane = self.lanes[(f, t)]
+        if success:
+            lane['batch'] = []
+            lane['attempt'] = 0
+            self.schedule(0, self.send_batch, f, t)
+        else:
+            self.schedule(retry_delay(lane['attempt']), self.send_batch, f, t)
+            lane['attempt'] += 1
+
+    def anti_entropy_round(self, server_id):
+        others = [srv_ip for (i, srv_ip) in enumerate(self.server_list) if i != server_id]
+        if len(others) > 0:
+            self.servers[server_id].sync_with(random.choice(others))
+            self.servers[server_id].collect_garbage()
+        self.schedule(ANTI_ENTROPY_INTERVAL_S, self.anti_entropy_round, server_id)
+
+    def converged(self):
+        expected = self.created - len(self.deleted)
+        board_hash = self.servers[0].board.get_hash()
+        return all(len(server.board) == expected and server.board.get_hash() == board_hash for server in self.servers)
+
+    # returns (converged, virtual time of convergence)
+    def run(self):
+        self.create_workload()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            while len(self.events) > 0:
+                (ts, _, fn, args) = heapq.heappop(self.events)
+                if ts > MAX_VIRTUAL_TIME_S:
+                    break
+                self.now = ts
+                fn(*args)
+                if self.workload_done and self.converged():
+                    return (True, self.now)
+        return (False, self.now)
+
+
+if __name__ == "__main__":
+    log_path = 'logs/simulation_log_' + datetime.now().strftime("%m-%d-%Y%-H-%M-%S") + '.csv'
+    os.makedirs('logs', exist_ok=True)
+
+    with open(log_path, 'a') as file:
+        file.write('scenario,number of servers,number of entries,seed,converged,virtual time,messages,wall time\n')
+
+    print(f"Writing results to {log_path}")
+    total_runs = 0
+    total_start = time.perf_counter()
+    for scenario in SCENARIOS:
+        for num_servers in SERVER_COUNTS:
+            for num_entries in ENTRY_COUNTS:
+                virtual_times = []
+                converged_runs = 0
+                for seed in range(FIRST_SEED, FIRST_SEED + RUNS):
+                    start_time = time.perf_counter()
+                    simulation = Simulation(num_servers, num_entries, scenario, seed)
+                    converged, virtual_time = simulation.run()
+                    wall_time = time.perf_counter() - start_time
+                    with open(log_path, 'a') as file:
+                        file.write(scenario + ',' + str(num_servers) + ',' + str(num_entries) + ',' + str(seed) + ','
+                                   + str(converged) + ',' + str(virtual_time) + ',' + str(simulation.messages) + ','
+                                   + str(wall_time) + '\n')
+                    total_runs += 1
+                    if converged:
+                        converged_runs += 1
+                        virtual_times.append(virtual_time)
+                mean_time = sum(virtual_times) / len(virtual_times) if len(virtual_times) > 0 else float('nan')
+                print(f"{scenario:18} servers={num_servers:>3} entries={num_entries:>5}: "
+                      f"converged {converged_runs}/{RUNS}, mean virtual time {mean_time:8.3f} s")
+
+    total_time = time.perf_counter() - total_start
+    print(f"{total_runs} runs in {total_time:.1f} s ({total_runs / total_time * 60:.0f} runs per minute)")
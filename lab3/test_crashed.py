@@ -21,7 +21,6 @@ IN_PARALLEL = True
 try:
     lc.build()  # build the servers to make sure that they are up to date for the test
     dsl_ctrl.init_servers(NUM_SERVERS)  # Initialize servers
-    dsl_ctrl.waits(5)  # Give servers some time to start, otherwise you will see a lot of errors...
     dsl_ctrl.wait_until(lambda: dsl_ctrl.assertion_online('all'))  # wait until all servers are online
     dsl_ctrl.change_scenario(SCENARIO)  # Change the scenario
 
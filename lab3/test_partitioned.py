@@ -24,7 +24,6 @@ IN_PARALLEL = True
 try:
     lc.build()  # build the servers to make sure that they are up to date for the test
     dsl_ctrl.init_servers(NUM_SERVERS)  # Initialize servers
-    dsl_ctrl.waits(5)  # Give servers some time to start, otherwise you will see a lot of errors...
     dsl_ctrl.wait_until(lambda: dsl_ctrl.assertion_online('all'))  # wait until all servers are online
     dsl_ctrl.change_scenario(SCENARIO_PARTITIONED)  # Change the scenario and partition the nodes, e.g., to partitions: [0, 2], [1, 3]
     dsl_ctrl.waits(5)  # Give the scenario some time to change...
@@ -43,7 +42,7 @@ try:
 
     start_time = time.time()
     dsl_ctrl.change_scenario(SCENARIO)  # Change the scenario back to the original one
-    dsl_ctrl.wait_until(lambda: dsl_ctrl.assertion_equal('all', 'all'))  # wait until all servers have the same number of entries this will loop if there is no consistency!
+    dsl_ctrl.wait_until_all_equal()  # wait until all servers have the same number of entries this will loop if there is no consistency!
     print("Time taken to reach consistency across all servers: " + str(time.time() - start_time))
 
     dsl_ctrl.waits(900) # leave the servers running for 15 minutes
@@ -5,6 +5,7 @@ import random
 import requests
 import threading
 import functools
+import json
 import math
 import time
 
@@ -225,6 +226,19 @@ class DSLTestControl():
         print(f"Scenario {name}")
         self.lc.change_scenario(name)
 
+    # clears board and outgoing messages of all servers, so the running cluster can be reused for the next test.
+    # The reset always covers the whole cluster: every server moves to the same new epoch (above the epoch of any
+    # server), and a server that misses the request adopts it from the messages of the others
+    def reset_servers(self):
+        print("Resetting all servers")
+        ids = range(self.lc.num_servers)
+        statuses = [self.sm.status(s) for s in ids]
+        epochs = [status['epoch'] for status in statuses if status is not None]
+        data = json.dumps({'epoch': max(epochs, default=0) + 1})
+        results = self.em.handle([functools.partial(self.sm.post, s, "/reset", data) for s in ids], in_parallel=True)
+        self.cm.crashed_servers.clear()
+        return all([success for (success, _) in results])
+
     def crash_servers(self, servers):
         print(f"Crashing servers {servers}")
         for s in self.parse_server_args(servers):
@@ -5,6 +5,7 @@
 # after 5 runs for one number of servers:
     # change to the next number of servers
 # end, when number of servers == 10
+# the cluster of one number of servers is started once and reset (POST /reset) between the runs
 
 import sys
 import os
@@ -25,6 +26,8 @@ log_path = 'logs/test_partitions_log_' + datetime.now().strftime("%m-%d-%Y%-H-%M
 with open(log_path, 'a') as file:
                     file.write('number of servers,number of entries,time to reach consistency in partitions,time until consistency on servers,test number,scenario\n')
 
+lc.build()  # build the servers once to make sure that they are up to date for the test
+
 for i in range (0,2): # to test functionality, only try perfect and easy for now
     NUM_ENTRIES = 10 # You might want to add more entries later to test consistency
     scenario_list = ['perfect', 'easy', 'medium', 'hard']
@@ -54,15 +57,15 @@ for i in range (0,2): # to test functionality, only try perfect and easy for now
             PARTITIONS = [[0,2,4,6,8],[1,3,6,7,9]]
         NUM_SERVERS = j # you can scale this up but need to change the partitions to test as well
 
-        for n in range(1,6): # increase number of entries SET TO 4 FOR 10,20,30 entries
-            NUM_ENTRIES = NUM_ENTRIES * n # test for 10, 20 and 30
-            k = 1
-            while (k <= 3): # SET TO 3 FOR THREE TESTS
-                try:
-                    lc.build()  # build the servers to make sure that they are up to date for the test
-                    dsl_ctrl.init_servers(NUM_SERVERS)  # Initialize servers
-                    dsl_ctrl.waits(5)  # Give servers some time to start, otherwise you will see a lot of errors...
-                    dsl_ctrl.wait_until(lambda: dsl_ctrl.assertion_online('all'))  # wait until all servers are online
+        try:
+            dsl_ctrl.init_servers(NUM_SERVERS)  # Initialize servers, the cluster is reused for all runs with this number of servers
+            dsl_ctrl.wait_until(lambda: dsl_ctrl.assertion_online('all'))  # wait until all servers are online
+
+            for n in range(1,6): # increase number of entries SET TO 4 FOR 10,20,30 entries
+                NUM_ENTRIES = NUM_ENTRIES * n # test for 10, 20 and 30
+                k = 1
+                while (k <= 3): # SET TO 3 FOR THREE TESTS
+                    dsl_ctrl.reset_servers()  # start with empty boards
                     dsl_ctrl.change_scenario(SCENARIO_PARTITIONED)  # Change the scenario and partition the nodes, e.g., to partitions: [0, 2], [1, 3]
                     dsl_ctrl.waits(5)  # Give the scenario some time to change...
 
@@ -88,13 +91,9 @@ for i in range (0,2): # to test functionality, only try perfect and easy for now
                         file.write(', ' +  str(time.time() - start_time) + ',' + str(k) + ',' + str(SCENARIO) + '\n')
                     
                     print("Time taken to reach consistency across all servers: " + str(time.time() - start_time))
-
-                    #dsl_ctrl.waits(900) # leave the servers running for 15 minutes
-                    dsl_ctrl.waits(2) # leave running for 2 seconds, then shutdown and go to next iteration
-                except KeyboardInterrupt:
-                    lc.shutdown()
-                finally:
-                    lc.shutdown()
-                #time.sleep(2) # sleep for a bit until all connections are properly reset
-                k = k+1
-            NUM_ENTRIES = 10
\ No newline at end of file
+                    k = k+1
+                NUM_ENTRIES = 10
+        except KeyboardInterrupt:
+            lc.shutdown()
+        finally:
+            lc.shutdown()
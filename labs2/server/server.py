@@ -15,6 +15,8 @@ import hashlib
 import requests
 import functools
 
+from dedup import DedupWindow
+
 # A simple entry in our board
 class Entry:
     def __init__(self, id, value):
@@ -30,23 +32,56 @@ class Entry:
     def from_dict(data: dict):
         return Entry(data['id'], data['value'])
 
+    def digest(self):
+        # stable hash of the entry content, sort_keys makes it independent of dict ordering
+        return int.from_bytes(hashlib.sha256(json.dumps(self.to_dict(), sort_keys=True).encode('utf-8')).digest(), 'big')
+
     def __str__(self):
         return str(self.to_dict())
 
+BOARD_HASH_MODULUS = 2 ** 256
+
 # ------------------------------------------------------------------------------------------------------
 # You need to synchronize the access to the board when you use multithreading in the server (e.g. using a Lock)
 class Board():
 
     def __init__(self):
+        self.clear()
+
+    def clear(self):
         self.indexed_entries = {}
+        # rolling hash of all entries: the sum of the entry digests (mod 2^256) can be updated per entry.
+        # The entries are ordered by their id, so the hash does not need to include the order
+        self.indexed_digests = {}   # entry id -> digest currently included in board_hash
+        self.board_hash = 0
 
     def add_entry(self, entry):
         self.indexed_entries[entry.id] = entry
+        self._rehash(entry)
 
     def get_ordered_entries(self):
         ordered_indices = sorted(list(self.indexed_entries.keys()))
         return [self.indexed_entries[k] for k in ordered_indices]
 
+    def _rehash(self, entry):
+        old_digest = self.indexed_digests.pop(entry.id, None)
+        if old_digest is not None:
+            self.board_hash = (self.board_hash - old_digest) % BOARD_HASH_MODULUS
+        digest = entry.digest()
+        self.board_hash = (self.board_hash + digest) % BOARD_HASH_MODULUS
+        self.indexed_digests[entry.id] = digest
+
+    def get_hash(self):
+        return format(self.board_hash, '064x')
+
+    def __len__(self):
+        return len(self.indexed_entries)
+
+# outgoing messages for the same server are coalesced into one batch message (see Server.propagate)
+PROPAGATE_MAX_BATCH = 50        # maximum number of messages in one batch
+PROPAGATE_MAX_LINGER_S = 0.05   # how long the propagate thread waits for more messages before sending
+PROPAGATE_RETRY_DELAY_S = 0.1   # wait before a failed batch is sent again
+
 # ------------------------------------------------------------------------------------------------------
 class Server(Bottle):
 
@@ -57,8 +92,9 @@ class Server(Bottle):
         self.server_list = server_list
         #TODO UUID
         self.uuid = uuid.uuid4()
-        # queue for outgoing messages Task 2
-        self.queue_out = queue.Queue()
+        # queues for outgoing messages Task 2, one queue and propagate thread per server, so that a failed batch is sent
+        # again before the later messages for the same server and a slow server only delays its own messages
+        self.queue_out = {srv_ip: queue.Queue() for srv_ip in self.server_list}
 
         #print("server started with uuid" + str(self.uuid))
 
@@ -66,11 +102,15 @@ class Server(Bottle):
             "crashed": False,
             "notes": "",
             "num_entries": 0, # we use this to generate ids for the entries
+            "epoch": 0,       # number of resets of the cluster, messages from an older epoch are dropped
+            "num_messages": 0, # sequence number of our last propagate message, the receivers drop duplicates by it
         }
+        self.message_ids = {}  # server id -> (uuid, DedupWindow) of the messages received from it
 
         self.lock = threading.RLock()  # use reentry lock for the server
         
-        threading.Thread(target=self.propagate, daemon=True).start() # thread for outgoing messages Task 2
+        for srv_ip in self.server_list:
+            threading.Thread(target=self.propagate, args=(srv_ip,), daemon=True).start() # threads for outgoing messages Task 2
         
         # Handle CORS
         self.route('/<:re:.*>', method='OPTIONS', callback=self.add_cors_headers)
@@ -80,6 +120,7 @@ class Server(Bottle):
         self.post('/crash', callback=self.crash_request)
         self.post('/recover', callback=self.recover_request)
         self.get('/status', callback=self.status_request)
+        self.post('/reset', callback=self.reset_request)   # clears the server, so a running cluster can be reused for the next test
 
         # Define REST URIs for the frontend (note that we define multiple update and delete routes right now)
         self.post('/entries', callback=self.create_entry_request)
@@ -114,8 +155,8 @@ class Server(Bottle):
                 return {
                     "entries": dict_entries,
                     "server_status": {
-                        "len": len(ordered_entries),
-                        "hash": hashlib.sha256((json.dumps(tuple(dict_entries)).encode('utf-8'))).hexdigest(),
+                        "len": len(self.board),
+                        "hash": self.board.get_hash(),
                         "crashed": self.status["crashed"],
                         "notes": self.status["notes"]
                     }  # we piggyback here allowing for a simple frontend implementation
@@ -129,13 +170,12 @@ class Server(Bottle):
         try:
 
             with self.lock:
-                ordered_entries = self.board.get_ordered_entries()
-                dict_entries = list(map(lambda entry: entry.to_dict(), ordered_entries))
                 return {
-                    "len": len(ordered_entries),
-                    "hash": hashlib.sha256((json.dumps(tuple(dict_entries)).encode('utf-8'))).hexdigest(),
+                    "len": len(self.board),
+                    "hash": self.board.get_hash(),
                     "crashed": self.status["crashed"],
-                    "notes": self.status["notes"]
+                    "notes": self.status["notes"],
+                    "epoch": self.status["epoch"]
                 }
         except Exception as e:
             print("[ERROR] " + str(e))
@@ -157,6 +197,44 @@ class Server(Bottle):
             print("[ERROR] " + str(e))
             raise e
 
+    # POST /reset {"epoch": <epoch>} resets the whole cluster to the given epoch (see LabsControl.reset_servers),
+    # without an epoch the server moves to the next one. A server that already got there from the messages of the
+    # others (see adopt_epoch) is not reset again
+    def reset_request(self):
+        try:
+            epoch = (request.json or {}).get('epoch', self.status['epoch'] + 1)
+            self.reset_epoch(epoch)
+            self.status['crashed'] = False
+            return {'epoch': self.status['epoch']}
+        except Exception as e:
+            print("[ERROR] " + str(e))
+            raise e
+
+    # Start over with an empty board in the given epoch. The epoch makes sure that messages which are still queued or
+    # in flight are dropped
+    def reset_epoch(self, epoch):
+        with self.lock:
+            if epoch <= self.status['epoch']:
+                return
+            self.status['epoch'] = epoch
+            self.status['num_entries'] = 0
+            self.status['num_messages'] = 0
+            for queue_out in self.queue_out.values():
+                while True:
+                    try:
+                        queue_out.get_nowait()
+                    except queue.Empty:
+                        break
+            self.board.clear()
+            self.message_ids.clear()
+
+    # Another server is in a newer epoch, so the cluster was reset while we did not get the request (e.g. we were
+    # restarted): we follow, otherwise we would drop all of its messages and it all of ours
+    def adopt_epoch(self, epoch):
+        if epoch is not None and epoch > self.status['epoch']:
+            print("Adopting epoch {} of another server".format(epoch))
+            self.reset_epoch(epoch)
+
     # This route is called whenever there is a new message for this server, you should handle everything in self.handle_message
     def message_request(self):
         try:
@@ -166,9 +244,13 @@ class Server(Bottle):
                 return None
             try:
                 # Please modify handle_message to return a response
-                return self.handle_message(request.json)
+                result = self.handle_message(request.json)
+                if result is not None and result.get('stale'):
+                    response.status = 409   # the sender keeps retrying until it learns our epoch from the response
+                return result
             except Exception as e:
                 print("[ERROR] " + str(e))
+                response.status = 500   # not handled, so the sender keeps the messages and sends them again
                 return None
         except Exception as e:
             print("[ERROR] " + str(e))
@@ -179,7 +261,7 @@ class Server(Bottle):
     # Do not modify this method if not necessary
     def _send_message(self, srv_ip, message):
         if self.status["crashed"]:
-            return False  # when we are crashed we do not send messages
+            return (False, None, None)  # when we are crashed we do not send messages
 
         success = False
         data = None
@@ -193,7 +275,7 @@ class Server(Bottle):
                                 timeout=1)  # timeout should stay at 1 sec
 
             # result can be accessed res.json()
-            if res.status_code == 200:
+            if res.status_code == 200 or res.status_code == 409:   # 409: the message is from an older epoch
                 data = res.json()
             if res.status_code == 200 or res.status_code == 204:
                 success = True
@@ -220,10 +302,12 @@ class Server(Bottle):
                 entry_id = str(timestamp) + str(id) # entry_id is timestamp + uuid
                 entry = Entry(entry_id, entry_value)
                 self.board.add_entry(entry)
+                self.status['num_messages'] += 1
+                seq = self.status['num_messages']
             # TODO: Propagate the entry to all other servers?!
             for other in self.server_list:
-                message = (other, {'type': 'propagate', 'entry_value': entry_value, 'entry_id': entry_id})
-                self.queue_out.put(message)
+                message = {'type': 'propagate', 'entry_value': entry_value, 'entry_id': entry_id, 'sent_from': self.id, 'seq': seq}
+                self.queue_out[other].put(message)
 
             return {}
         except Exception as e:
@@ -263,31 +347,88 @@ class Server(Bottle):
             print("[ERROR] " + str(e))
             raise e
 
-    # send propagation messages from outgoing queue Task 2
-    def propagate(self):
+    # send propagation messages from the outgoing queue of one server Task 2
+    def propagate(self, srv_ip):
+        batch = []
+        epoch = self.status['epoch']
         while True:
-            message = self.queue_out.get()
-            result = self.send_message(message[0], message[1])
-            if result[0] == False:
-                self.queue_out.put(message)
-            
+            # all pending messages for the server are sent together, in batches of at most PROPAGATE_MAX_BATCH.
+            # A failed batch is kept and sent again (topped up with new messages) to preserve the order
+            if epoch != self.status['epoch']:
+                batch = []  # the server was reset meanwhile, the messages belong to the old board
+            if len(batch) == 0:
+                batch.append(self.queue_out[srv_ip].get())
+                epoch = self.status['epoch']  # read before waiting for more, a reset meanwhile drops the batch
+            batch = self.collect_pending(self.queue_out[srv_ip], batch)
+            result = self.send_message(srv_ip, {'type': 'batch', 'messages': batch, 'epoch': epoch, 'uuid': str(self.uuid)})
+            if result[0] == True:
+                batch = []
+            else:
+                time.sleep(PROPAGATE_RETRY_DELAY_S)
+
+    # add everything queued within PROPAGATE_MAX_LINGER_S to the batch
+    def collect_pending(self, queue_out, batch):
+        deadline = time.time() + PROPAGATE_MAX_LINGER_S
+        while len(batch) < PROPAGATE_MAX_BATCH:
+            try:
+                batch.append(queue_out.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return batch
 
     def send_message(self, srv_ip, message):
         # TODO: Implement your custom code here, use your solution to lab 1 to send messages between servers reliably
         # - What if the request gets lost?
         # - What if the request is delayed?
         # - What if the response gets lost?
-        return self._send_message(srv_ip, message)
-
+        result = self._send_message(srv_ip, message)
+        if not result[0] and result[1] is not None:
+            self.adopt_epoch(result[1].get('epoch'))
+        return result
+
+
+    # the sequence numbers received from the sender of a message in a batch from the server with the given uuid (None for
+    # messages without one). A restarted server has a new uuid and starts again at 1, so its window is replaced
+    def get_message_ids(self, sender_uuid, message):
+        if 'seq' not in message:
+            return None
+        ids = self.message_ids.get(message['sent_from'])
+        if ids is None or ids[0] != sender_uuid:
+            ids = (sender_uuid, DedupWindow())
+            self.message_ids[message['sent_from']] = ids
+        return ids[1]
 
     # This method is called for every message received
     def handle_message(self, message):
         # Note that you might need to use the lock
-        print("Received message: ", message)
         type = message['type']
+        if type == 'batch':    # the messages inside are printed one by one when they are handled
+            seqs = [m.get('seq') for m in message['messages']]
+            sender = message['messages'][0].get('sent_from') if seqs else None
+            print("Received batch from {}: {} messages, seq {}..{}".format(sender, len(seqs), seqs[0] if seqs else None, seqs[-1] if seqs else None))
+        else:
+            print("Received message: ", message)
         
+        # batch message from the propagate thread of another server, handle every message on its own
+        if type == 'batch':
+            self.adopt_epoch(message.get('epoch'))
+            with self.lock:     # a reset can not happen while the batch is handled
+                # messages sent before the last reset belong to the old board, the answer tells the sender our epoch
+                if message.get('epoch', self.status['epoch']) < self.status['epoch']:
+                    return {'stale': True, 'epoch': self.status['epoch']}
+                results = []
+                for m in message['messages']:
+                    ids = self.get_message_ids(message.get('uuid'), m)
+                    if ids is not None and m['seq'] in ids:
+                        results.append({})  # sent again because a response got lost, it was already applied
+                        continue
+                    results.append(self.handle_message(m))
+                    if ids is not None:
+                        ids.add(m['seq'])   # only now, a message that failed is applied when it is sent again
+                return {'results': results}
+
         # propagation message: add entry to board  Task 2
-        if type == 'propagate':
+        elif type == 'propagate':
                 entry_value = message['entry_value']
                 entry_id = message['entry_id']
                 with self.lock:
@@ -0,0 +1,27 @@
+# ids of a sender that are more than DEDUP_WINDOW_SIZE below its newest id are treated as seen
+DEDUP_WINDOW_SIZE = 1024
+
+
+# Duplicate suppression for the messages of one sender, numbered 1, 2, 3, ... in the order they are sent.
+# Every id up to high_water was seen, the ids above it that arrived out of order are kept in a set until the gap below
+# them is filled. A check is O(1) and the set never holds more than DEDUP_WINDOW_SIZE ids
+class DedupWindow():
+    def __init__(self):
+        self.high_water = 0
+        self.newest = 0
+        self.seen = set()
+
+    # records the id, returns False if it was seen before
+    def add(self, message_id):
+        if message_id <= self.high_water or message_id in self.seen:
+            return False
+        self.seen.add(message_id)
+        self.newest = max(self.newest, message_id)
+        # a gap that stays open for the whole window is given up
+        for old_id in range(self.high_water + 1, self.newest - DEDUP_WINDOW_SIZE + 1):
+            self.seen.discard(old_id)
+            self.high_water = old_id
+        while self.high_water + 1 in self.seen:
+            self.high_water += 1
+            self.seen.remove(self.high_water)
+        return True
@@ -8,10 +8,13 @@ import os
 import time
 import json
 import hashlib
+import random
 
 import requests
 import functools
 
+from dedup import DedupWindow
+
 # A simple entry in our board
 class Entry:
     def __init__(self, id, value):
@@ -27,23 +30,63 @@ class Entry:
     def from_dict(data: dict):
         return Entry(data['id'], data['value'])
 
+    def digest(self):
+        # stable hash of the entry content, sort_keys makes it independent of dict ordering
+        return int.from_bytes(hashlib.sha256(json.dumps(self.to_dict(), sort_keys=True).encode('utf-8')).digest(), 'big')
+
     def __str__(self):
         return str(self.to_dict())
 
+BOARD_HASH_MODULUS = 2 ** 256
+
+# failed sends are retried with exponential backoff
+RETRY_BASE_DELAY_S = 0.05
+RETRY_MAX_DELAY_S = 2.0
+
+def retry_delay(attempt):
+    # exponential backoff with jitter: a random delay between half and the full backoff
+    delay = min(RETRY_MAX_DELAY_S, RETRY_BASE_DELAY_S * (2 ** attempt))
+    return random.uniform(delay / 2, delay)
+
+# the coordinator streams its log to every other server with up to PIPELINE_DEPTH batches in flight
+PIPELINE_DEPTH = 4
+PIPELINE_MAX_BATCH = 50
+# at most this many entries are sent beyond what a server acknowledged (has to stay below DEDUP_WINDOW_SIZE in dedup.py)
+PIPELINE_WINDOW = 512
+
 # ------------------------------------------------------------------------------------------------------
 # You need to synchronize the access to the board when you use multithreading in the server (e.g. using a Lock)
 class Board():
 
     def __init__(self):
         self.indexed_entries = {} # indexed_entries is defined on initialization
+        # rolling hash of all entries: the sum of the entry digests (mod 2^256) can be updated per entry.
+        # The entries are ordered by their id, so the hash does not need to include the order
+        self.indexed_digests = {}   # entry id -> digest currently included in board_hash
+        self.board_hash = 0
 
     def add_entry(self, entry):                 # entry is passed to function
         self.indexed_entries[entry.id] = entry  # entry is added to board's own indexed_entry list by id
+        self._rehash(entry)
 
     def get_ordered_entries(self):
         ordered_indices = sorted(list(self.indexed_entries.keys()))
         return [self.indexed_entries[k] for k in ordered_indices]
 
+    def _rehash(self, entry):
+        old_digest = self.indexed_digests.pop(entry.id, None)
+        if old_digest is not None:
+            self.board_hash = (self.board_hash - old_digest) % BOARD_HASH_MODULUS
+        digest = entry.digest()
+        self.board_hash = (self.board_hash + digest) % BOARD_HASH_MODULUS
+        self.indexed_digests[entry.id] = digest
+
+    def get_hash(self):
+        return format(self.board_hash, '064x')
+
+    def __len__(self):
+        return len(self.indexed_entries)
+
 # ------------------------------------------------------------------------------------------------------
 class Server(Bottle):
 
@@ -57,6 +100,9 @@ class Server(Bottle):
             "crashed": False,
             "notes": "",
             "num_entries": 0, # we use this to generate ids for the entries
+            "num_requests": 0, # ids of our add_entry messages, the coordinator drops duplicates by them
+            "create_entry_ids": [DedupWindow() for _ in server_list],  # add_entry messages seen by the coordinator, per server
+            "propagate_ids": [DedupWindow() for _ in server_list],     # propagate messages seen, per sending server
         }
 
         self.lock = threading.RLock() # use reentry lock for the server
@@ -81,6 +127,16 @@ class Server(Bottle):
 
         self.board = Board()
 
+        # the coordinator (ID 0) is a sequencer: it gives every new entry the next id, appends it to its log and streams
+        # the log to the other servers in the background, so an add_entry request does not wait for them
+        self.log = []                                       # all entries in the order of their id (id = position + 1)
+        self.log_changed = threading.Condition(self.lock)   # notified on new entries and acknowledgements
+        self.streams = {srv_ip: {'next': 1, 'acked': 0} for (i, srv_ip) in enumerate(server_list) if i != self.id}
+        if self.id == 0:
+            for srv_ip in self.streams:
+                for _ in range(PIPELINE_DEPTH):
+                    threading.Thread(target=self.stream_log, args=(srv_ip,), daemon=True).start()
+
     # Please try to avoid modifying the following methods
     # ------------------------------------------------------------------------------------------------------
     def add_cors_headers(self):
@@ -103,8 +159,8 @@ class Server(Bottle):
                 return {
                     "entries": dict_entries,
                     "server_status": {
-                        "len": len(ordered_entries),
-                        "hash": hashlib.sha256((json.dumps(tuple(dict_entries)).encode('utf-8'))).hexdigest(),
+                        "len": len(self.board),
+                        "hash": self.board.get_hash(),
                         "crashed": self.status["crashed"],
                         "notes": self.status["notes"]
                     }  # we piggyback here allowing for a simple frontend implementation
@@ -118,11 +174,9 @@ class Server(Bottle):
         try:
 
             with self.lock:
-                ordered_entries = self.board.get_ordered_entries()
-                dict_entries = list(map(lambda entry: entry.to_dict(), ordered_entries))
                 return {
-                    "len": len(ordered_entries),
-                    "hash": hashlib.sha256((json.dumps(tuple(dict_entries)).encode('utf-8'))).hexdigest(),
+                    "len": len(self.board),
+                    "hash": self.board.get_hash(),
                     "crashed": self.status["crashed"],
                     "notes": self.status["notes"]
                 }
@@ -169,7 +223,7 @@ class Server(Bottle):
     # Do not modify this method if not necessary
     def _send_message(self, srv_ip, message):
         if self.status["crashed"]:
-            return False  # when we are crashed we do not send messages
+            return (False, None, None)  # when we are crashed we do not send messages
 
         success = False
         data = None
@@ -203,7 +257,8 @@ class Server(Bottle):
 
             entry_value = request.forms.get('value')
             with self.lock:
-                    create_entry_id = self.status['num_entries'] + 1
+                self.status['num_requests'] += 1
+                create_entry_id = self.status['num_requests']
 
             self.send_message(self.server_list[0], {'type': 'add_entry', 'entry_value': entry_value, 'create_entry_id': create_entry_id, 'from_server': self.id})
 
@@ -251,18 +306,49 @@ class Server(Bottle):
         # - What if the response gets lost? (optional)
         
         res = self._send_message(srv_ip, message)
+        attempt = 0
         while (res[0] != True):
-            res = self.send_message(srv_ip, message)
-        
+            time.sleep(retry_delay(attempt))    # back off instead of hammering a server that is not reachable
+            attempt += 1
+            res = self._send_message(srv_ip, message)
+
         return res
 
+    # One of the PIPELINE_DEPTH threads of the coordinator that send the log to a server: each takes the next batch
+    # of the log and sends it until it is acknowledged, while the other threads already send the following batches.
+    # The server acknowledges all entries up to its first gap, so a batch whose response got lost does not need to be
+    # sent again once a later batch acknowledged it
+    def stream_log(self, srv_ip):
+        stream = self.streams[srv_ip]
+        while True:
+            with self.log_changed:
+                self.log_changed.wait_for(lambda: stream['next'] <= len(self.log) and stream['next'] - stream['acked'] <= PIPELINE_WINDOW)
+                first = stream['next']
+                batch = [entry.to_dict() for entry in self.log[first - 1:first - 1 + PIPELINE_MAX_BATCH]]
+                stream['next'] += len(batch)
+            last = first + len(batch) - 1
+
+            attempt = 0
+            while True:
+                success, data, _ = self._send_message(srv_ip, {'type': 'propagate', 'entries': batch, 'from_server': self.id})
+                if success and data is not None:
+                    with self.log_changed:
+                        stream['acked'] = max(stream['acked'], data['ack'])
+                        self.log_changed.notify_all()
+                    break
+                with self.lock:
+                    if stream['acked'] >= last:
+                        break
+                time.sleep(retry_delay(attempt))
+                attempt += 1
+
     # This method is called whenever a message is received
     # Note that this function call will block one of the NUM_THREADS threads that handle the web server
     # so if you intend to block for a long time, you should spawn a new thread, for example (but be careful with locking)
     # We provide a basic implementation for the coordinator:
     #   - If a server wants to add a new entry, it will send an 'add_entry' message to the coordinator
-    #   - The coordinator will propagate it to all other servers (including itself)
-    #   - If a server receives a 'propagate' message, it will add the entry to the board
+    #   - The coordinator adds it to its log and board, the stream_log threads send it to all other servers
+    #   - If a server receives a 'propagate' message, it will add the entries to the board
     def handle_message(self, message):
         # Note that you might need to use the lock
         print("Received message: ", message)
@@ -273,32 +359,29 @@ class Server(Bottle):
             if type == 'add_entry':
 
                 assert self.id == 0 # ID 0 is coordinator only this server should receive add_entry messages right now
-                if self.status['num_entries'] == 0:
-                    self.status['create_entry_ids'] = [[] for x in range(len(self.server_list))] # initialize with one empty list per server
-                
+
                 entry_value = message['entry_value']
+                create_entry_id = message['create_entry_id']
+                from_server = message['from_server']
                 # critical section start
                 with self.lock:
-                    entry_id = self.status['num_entries'] + 1 # coordinator generated id which is sent to all servers
+                    if self.status['create_entry_ids'][from_server].add(create_entry_id): # False if the message is a duplicate
+                        entry = Entry(len(self.log) + 1, entry_value) # coordinator generated id which is sent to all servers
+                        self.log.append(entry)
+                        self.status['num_entries'] += 1
+                        self.board.add_entry(entry)
+                        self.log_changed.notify_all()
                 # critical section end
-                create_entry_id = message['create_entry_id']
-                from_server = message['from_server']
-                
-                # We can safely propagate here since we always have a single frontend client, right? So no need to lock, right? Right?!
-                if create_entry_id not in self.status['create_entry_ids'][from_server]: # check if message is doublicate
-                    self.status['create_entry_ids'][from_server].append(create_entry_id)
-                    for other in self.server_list:
-                        # TODO: Send message to other servers concurrently?
-                        self.send_message(other, {'type': 'propagate', 'entry_value': entry_value, 'entry_id': entry_id})
 
             elif type == 'propagate':
-                entry_value = message['entry_value']
-                entry_id = message['entry_id'] # get id from coordinator
-                # Let's hope this is from the coordinator
+                # a batch of the coordinator log, the entries might arrive out of order (several batches are in flight)
                 with self.lock:
-                    self.status['num_entries'] += 1
-                    entry = Entry(entry_id, entry_value) # use id generated by coordinator
-                    self.board.add_entry(entry)
+                    window = self.status['propagate_ids'][message['from_server']]
+                    for data in message['entries']:
+                        if window.add(data['id']):   # False if it was sent again because a response got lost
+                            self.status['num_entries'] += 1
+                            self.board.add_entry(Entry.from_dict(data)) # use id generated by coordinator
+                    return {'ack': window.high_water}   # everything up to the first gap
             else:
                 print("Received weird message?")
 